@@ -0,0 +1,84 @@
+"""Benchmark of the top-K selection of build_statistic().
+
+Builds report entries for N distinct URLs with random time sums (many of
+them equal, as in real logs) and measures selecting the report_size
+largest of them with a full sort, with a bounded heap and with
+select_top(), which picks one of the two by TOP_HEAP_RATIO, checking that
+all of them give the same entries in the same order:
+
+    python bench_top.py -n 10000,100000,1000000 -k 1000,10000
+"""
+import argparse
+import heapq
+import random
+import time
+
+from log_analyzer import select_top, time_sum_key
+
+
+def make_entries(urls, seed=0):
+    rng = random.Random(seed)
+    return {
+        '/api/v2/banner/{}'.format(i): {
+            'count': 1, 'time_sum': int(rng.expovariate(1e-5)) // 1000 * 1000,
+        }
+        for i in range(urls)
+    }
+
+
+def top_sorted(entries, size):
+    return sorted(entries.values(), key=time_sum_key, reverse=True)[:size]
+
+
+def top_heap(entries, size):
+    return heapq.nlargest(size, entries.values(), key=time_sum_key)
+
+
+def best_of(function, entries, size, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(entries, size)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-n', '--urls', default='10000,100000,1000000',
+        help='Comma separated numbers of distinct URLs.'
+    )
+    parser.add_argument(
+        '-k', '--report-sizes', default='1000',
+        help='Comma separated numbers of selected URLs.'
+    )
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print('{:>10} {:>8} {:>10} {:>10} {:>10}'.format(
+        'urls', 'k', 'sort ms', 'heap ms', 'select ms'))
+    for urls in map(int, args.urls.split(',')):
+        entries = make_entries(urls)
+        for size in map(int, args.report_sizes.split(',')):
+            timings = []
+            expected = None
+            for function in (top_sorted, top_heap, select_top):
+                elapsed, result = best_of(function, entries, size,
+                                          args.repeat)
+                timings.append(elapsed * 1000)
+                if expected is None:
+                    expected = result
+                # the very same entry objects, ties in the same order
+                assert len(result) == len(expected)
+                assert all(a is b for a, b in zip(result, expected))
+            print('{:>10} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                urls, size, *timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,17 +13,29 @@ import glob
 import json
 import re
 import logging
-import gzip
-import statistics
-from collections import defaultdict
+import bisect
+import heapq
+import math
+import multiprocessing
+import zlib
+from array import array
+from collections import deque
 from functools import wraps
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 DEFAULT_CONF = {
     'report_size': 1000,
     'report_dir': './',
     'log_dir': './',
     'ts_file': './log_analyzer.ts',
+    'jobs': 1,
+    'quantile_error': 0.01,
+    'engine': 'python',
 }
 
 
@@ -43,6 +55,19 @@ LOG_PATTERN = re.compile(
             r'"(?P<http_X_RB_USER>.+)"\s+'
             r'(?P<request_time>.+)'
         )
+# compressed bytes read at once and decompressed bytes handed to a worker
+GZIP_CHUNK_SIZE = 1024 * 1024
+GZIP_BLOCK_SIZE = 8 * 1024 * 1024
+GZIP_INDEX_VERSION = 1
+# relative error of the estimated request time quantiles
+QUANTILE_ERROR = 0.01
+# a heap is faster than a full sort for selecting at most 1/TOP_HEAP_RATIO
+# of the URLs, see bench_top.py
+TOP_HEAP_RATIO = 32
+# requests aggregated at once by the numpy engine
+NUMPY_BATCH_SIZE = 1000000
+QUANTILES = (('time_med', 0.5), ('time_p90', 0.9), ('time_p95', 0.95),
+             ('time_p99', 0.99))
 FIELDS = ('request', 'request_time', )
 PARSERS = {'request': lambda r: r.split(' ')[1]}
 
@@ -71,14 +96,226 @@ def scan_dir(dir_path, file_name_pattern, dt_pattern=DT_PATTERN):
 
 def read_file(path):
     if path.endswith('gz'):
-        log_file = gzip.open(path, 'rb')
-    else:
-        log_file = open(path, 'rb')
+        with open(path, 'rb') as log_file:
+            yield from iter_lines(iter_gzip(log_file))
+        return
+    log_file = open(path, 'rb')
     for line in log_file:
         yield line.decode('utf-8')
     log_file.close()
 
 
+def iter_gzip(log_file, index=None):
+    """Yield the decompressed data of a gzip file from the current position.
+
+    If index is given, every member (gzip files may be concatenated) is
+    appended to index['members'] as [compressed offset, decompressed
+    offset, whether the member starts with a new line] and the total
+    decompressed size is stored as index['uncompressed_size'].
+    """
+    position = log_file.tell()
+    produced = 0
+    previous = b'\n'
+    decompressor = None
+    data = b''
+    while True:
+        if not data:
+            data = log_file.read(GZIP_CHUNK_SIZE)
+            if not data:
+                break
+        if decompressor is None:
+            # members may be padded with zeros
+            stripped = data.lstrip(b'\0')
+            position += len(data) - len(stripped)
+            data = stripped
+            if not data:
+                continue
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            if index is not None:
+                index['members'].append(
+                    [position, produced, previous == b'\n']
+                )
+        block = decompressor.decompress(data)
+        if block:
+            produced += len(block)
+            previous = block[-1:]
+            yield block
+        if decompressor.eof:
+            rest = decompressor.unused_data
+            position += len(data) - len(rest)
+            data = rest
+            decompressor = None
+        else:
+            position += len(data)
+            data = b''
+    if decompressor is not None:
+        raise EOFError('Compressed file ended before the end-of-stream '
+                       'marker was reached')
+    if index is not None:
+        index['uncompressed_size'] = produced
+
+
+def iter_lines(blocks):
+    """Split decompressed blocks into lines without the line breaks."""
+    tail = b''
+    for block in blocks:
+        end = block.rfind(b'\n')
+        if end < 0:
+            tail += block
+            continue
+        lines = (tail + block[:end]).decode('utf-8').split('\n')
+        tail = block[end + 1:]
+        yield from lines
+    if tail:
+        yield tail.decode('utf-8')
+
+
+def line_blocks(blocks):
+    """Regroup decompressed blocks into newline-aligned GZIP_BLOCK_SIZE ones.
+
+    The trailing line break of every block is dropped.
+    """
+    pending = []
+    size = 0
+    for block in blocks:
+        pending.append(block)
+        size += len(block)
+        if size < GZIP_BLOCK_SIZE:
+            continue
+        data = b''.join(pending)
+        end = data.rfind(b'\n')
+        if end < 0:
+            pending = [data]
+            continue
+        yield data[:end]
+        pending = [data[end + 1:]]
+        size = len(pending[0])
+    data = b''.join(pending)
+    if data:
+        yield data[:-1] if data.endswith(b'\n') else data
+
+
+def range_blocks(blocks, size):
+    """Cut the blocks after the line containing byte size - 1."""
+    produced = 0
+    for block in blocks:
+        start = size - 1 - produced
+        produced += len(block)
+        if start < len(block):
+            end = block.find(b'\n', max(start, 0))
+            if end >= 0:
+                yield block[:end + 1]
+                return
+        yield block
+
+
+def skip_line(blocks):
+    """Drop the data up to and including the first line break."""
+    blocks = iter(blocks)
+    for block in blocks:
+        end = block.find(b'\n')
+        if end >= 0:
+            yield block[end + 1:]
+            break
+    yield from blocks
+
+
+def gzip_index_path(path):
+    # a dot file, so that it is not matched by the log name pattern
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.{}.idx'.format(tail))
+
+
+def load_gzip_index(path):
+    """Return the members of a gzip log from its index or None."""
+    try:
+        stat = os.stat(path)
+        with open(gzip_index_path(path), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != GZIP_INDEX_VERSION or \
+            index.get('size') != stat.st_size or \
+            index.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return index
+
+
+def save_gzip_index(path, index):
+    try:
+        stat = os.stat(path)
+        index.update(
+            version=GZIP_INDEX_VERSION, size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns
+        )
+        with open(gzip_index_path(path), 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+    except OSError as error:
+        logging.warning('Can not save the gzip index of {}: {}'.format(
+            path, error
+        ))
+
+
+def split_members(index, parts):
+    """Group the members of a gzip log into at most parts ranges.
+
+    Returns (compressed offset, decompressed offset, decompressed end,
+    whether the first line belongs to the previous range) tuples.
+    """
+    members = index['members']
+    total = index['uncompressed_size']
+    offsets = [member[1] for member in members]
+    starts = sorted(set(
+        bisect.bisect_left(offsets, total * part // parts)
+        for part in range(parts)
+    ))
+    starts = [start for start in starts if start < len(members)]
+    ranges = []
+    for i, start in enumerate(starts):
+        position, offset, starts_line = members[start]
+        end = members[starts[i + 1]][1] if i + 1 < len(starts) else total
+        if offset < end:
+            ranges.append((position, offset, end, not starts_line))
+    return ranges
+
+
+def split_file(path, parts):
+    """Split a plain-text file into at most parts newline-aligned ranges.
+
+    Returns a list of (start, end) byte offsets, every line belongs to
+    exactly one range.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as log_file:
+        for part in range(1, parts):
+            offset = size * part // parts
+            if offset <= bounds[-1]:
+                continue
+            # the line crossing the offset belongs to the previous range
+            log_file.seek(offset - 1)
+            log_file.readline()
+            if log_file.tell() >= size:
+                break
+            if log_file.tell() > bounds[-1]:
+                bounds.append(log_file.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:])
+            if start < end]
+
+
+def read_range(path, start, end):
+    with open(path, 'rb') as log_file:
+        log_file.seek(start)
+        position = start
+        while position < end:
+            line = log_file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+
 def get_perc(value, total, ndigits=2):
     return round(value / (total / 100), ndigits)
 
@@ -87,47 +324,342 @@ def get_mid(value, total, ndigits=2):
     return round(total / value, ndigits)
 
 
-def add_report_line(report, url, request_time):
-    if url not in report:
-        report[url] = defaultdict(lambda: 0)
-        report[url]['med'] = []
-    report[url]['count'] += 1
-    report[url]['time_sum'] = round(report[url]['time_sum'] + request_time, 2)
-    report[url]['med'].append(request_time)
-    if request_time > report[url]['time_max']:
-        report[url]['time_max'] = request_time
+class Quantiles:
+    """Mergeable streaming estimate of the quantiles of request times.
+
+    Times are counted in buckets growing by a constant factor, so every
+    quantile is estimated with a relative error of at most error and the
+    memory depends on the spread of the times, not on their number.
+    """
+
+    def __init__(self, error=QUANTILE_ERROR):
+        self.error = error
+        self.gamma = (1 + error) / (1 - error)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        # times of 0 have no logarithm
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        key = self.key(value)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def key(self, value):
+        """Return the bucket of a positive value."""
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError('Can not merge quantiles of different errors')
+        self.count += other.count
+        self.zeros += other.zeros
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def estimate(self, key):
+        # the point of the bucket (gamma ** (key - 1), gamma ** key] with
+        # the smallest relative distance to both of its ends
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantiles(self, fractions):
+        """Return the estimated quantiles for the ascending fractions."""
+        result = []
+        seen = self.zeros
+        keys = iter(sorted(self.buckets))
+        key = None
+        for fraction in fractions:
+            rank = fraction * (self.count - 1)
+            if rank < self.zeros:
+                result.append(0.0)
+                continue
+            while seen <= rank:
+                key = next(keys)
+                seen += self.buckets[key]
+            result.append(self.estimate(key))
+        return result
+
+
+def add_report_line(report, url, request_time, error=QUANTILE_ERROR):
+    entry = report.get(url)
+    if entry is None:
+        entry = report[url] = {
+            'count': 0, 'time_sum': 0, 'time_max': 0,
+            'times': Quantiles(error),
+        }
+    entry['count'] += 1
+    # exact integer microseconds, so that the sums do not depend on the
+    # order in which parts of the log are added up
+    entry['time_sum'] += round(request_time * 1000000)
+    entry['times'].add(request_time)
+    if request_time > entry['time_max']:
+        entry['time_max'] = request_time
+
+
+def time_sum_key(entry):
+    return entry.get('time_sum', 0)
+
+
+def select_top(entries, r_size):
+    """Return the r_size entries with the largest time_sum, largest first.
+
+    Small reports of many URLs are selected with a heap of r_size entries
+    instead of sorting all of them. Both give the order of a stable sort,
+    ties included.
+    """
+    if r_size * TOP_HEAP_RATIO <= len(entries):
+        return heapq.nlargest(r_size, entries.values(), key=time_sum_key)
+    return sorted(entries.values(), key=time_sum_key, reverse=True)[:r_size]
 
 
 def build_statistic(entries, total_requests, requests_time, r_size):
-    result = sorted(
-        entries.values(), key=lambda entry: entry.get('time_sum', 0),
-        reverse=True
-    )[:r_size]
+    """Render the r_size URLs with the largest time_sum as JSON.
+
+    The time sums of entries and requests_time are in microseconds.
+    """
+    result = select_top(entries, r_size)
     for entry in result:
         try:
-            entry['med'] = statistics.median(entry['med'])
+            estimates = entry.pop('times').quantiles(
+                [fraction for _, fraction in QUANTILES]
+            )
+            for (name, _), estimate in zip(QUANTILES, estimates):
+                entry[name] = round(estimate, 3)
             entry['count_perc'] = get_perc(entry['count'], total_requests)
             entry['time_perc'] = get_perc(entry['time_sum'], requests_time)
+            entry['time_sum'] = round(entry['time_sum'] / 1000000, 2)
             entry['time_avg'] = get_perc(entry['time_sum'], entry['count'])
         except KeyError:
             logging.error(
-                'The reports entry should have the count, time_sum and med!'
+                'The reports entry should have the count, time_sum and times!'
             )
     return json.dumps(result)
 
 
-def create_report(log_path, r_size):
+def aggregate(lines, error=QUANTILE_ERROR):
+    """Parse the lines into (report, total_requests, total_requests_time).
+
+    The request times are summed up in microseconds.
+    """
     total_requests = 0
     total_requests_time = 0
     report = {}
-    for entry in (parse(line) for line in read_file(log_path)):
+    for entry in (parse(line) for line in lines):
         if entry is None:
             continue
         url = entry.get('request') or '-'
         total_requests += 1
         request_time = float(entry.get('request_time')) or float(0)
-        total_requests_time += request_time
-        add_report_line(report, url, request_time)
+        total_requests_time += round(request_time * 1000000)
+        add_report_line(report, url, request_time, error)
+    return report, total_requests, total_requests_time
+
+
+def group_times(urls, ids, times, error=QUANTILE_ERROR):
+    """Aggregate the requests of a batch with numpy.
+
+    The request i was made to urls[ids[i]] and took times[i] seconds, ids
+    and times are arrays of the 'q' and 'd' types. The result is the one
+    of aggregate() for the same requests.
+    """
+    if not times:
+        return {}, 0, 0
+    ids = np.frombuffer(ids, dtype=np.int64)
+    times = np.frombuffer(times, dtype=np.float64)
+    us = np.rint(times * 1000000).astype(np.int64)
+    # the buckets are found by Quantiles.key() for every distinct time, so
+    # that they do not depend on the rounding of numpy's log()
+    sketch = Quantiles(error)
+    values, inverse = np.unique(times, return_inverse=True)
+    zero_key = np.iinfo(np.int64).min
+    keys = np.array(
+        [sketch.key(value) if value > 0 else zero_key
+         for value in values.tolist()], dtype=np.int64
+    )[inverse.ravel()]
+
+    # group the requests by URL and by bucket within the URL
+    order = np.lexsort((keys, ids))
+    ids = ids[order]
+    keys = keys[order]
+    new_url = np.empty(len(ids), dtype=bool)
+    new_url[0] = True
+    np.not_equal(ids[1:], ids[:-1], out=new_url[1:])
+    new_bucket = new_url.copy()
+    new_bucket[1:] |= keys[1:] != keys[:-1]
+    url_starts = np.flatnonzero(new_url)
+    bucket_starts = np.flatnonzero(new_bucket)
+
+    report = {}
+    # ids are given in the order in which the URLs first appear
+    for url_id, count, time_sum, time_max in zip(
+            ids[url_starts].tolist(),
+            np.diff(url_starts, append=len(ids)).tolist(),
+            np.add.reduceat(us[order], url_starts).tolist(),
+            np.maximum.reduceat(times[order], url_starts).tolist()):
+        report[urls[url_id]] = {
+            'count': count, 'time_sum': time_sum,
+            'time_max': time_max if time_max > 0 else 0,
+            'times': Quantiles(error),
+        }
+    for url_id, key, count in zip(
+            ids[bucket_starts].tolist(), keys[bucket_starts].tolist(),
+            np.diff(bucket_starts, append=len(ids)).tolist()):
+        quantiles = report[urls[url_id]]['times']
+        quantiles.count += count
+        if key == zero_key:
+            quantiles.zeros += count
+        else:
+            quantiles.buckets[key] = count
+    return report, len(times), int(us.sum())
+
+
+def numpy_batches(lines, error=QUANTILE_ERROR):
+    """Yield the aggregates of every NUMPY_BATCH_SIZE requests."""
+    urls = {}
+    ids = array('q')
+    times = array('d')
+    for entry in (parse(line) for line in lines):
+        if entry is None:
+            continue
+        url = entry.get('request') or '-'
+        ids.append(urls.setdefault(url, len(urls)))
+        times.append(float(entry.get('request_time')) or float(0))
+        if len(times) >= NUMPY_BATCH_SIZE:
+            yield group_times(list(urls), ids, times, error)
+            urls = {}
+            ids = array('q')
+            times = array('d')
+    yield group_times(list(urls), ids, times, error)
+
+
+def aggregate_numpy(lines, error=QUANTILE_ERROR):
+    """Like aggregate() but the requests are aggregated by numpy."""
+    return merge_reports(numpy_batches(lines, error))
+
+
+ENGINES = {'python': aggregate, 'numpy': aggregate_numpy}
+
+
+def aggregate_range(log_path, start, end, error=QUANTILE_ERROR,
+                    engine='python'):
+    """Aggregate a byte range of a plain-text log in a worker process."""
+    return ENGINES[engine](read_range(log_path, start, end), error)
+
+
+def aggregate_block(data, error=QUANTILE_ERROR, engine='python'):
+    """Aggregate a newline-aligned block of a decompressed log."""
+    return ENGINES[engine](data.decode('utf-8').split('\n'), error)
+
+
+def aggregate_members(log_path, position, start, end, skip_first,
+                      error=QUANTILE_ERROR, engine='python'):
+    """Decompress and aggregate a range of gzip members in a worker."""
+    with open(log_path, 'rb') as log_file:
+        log_file.seek(position)
+        blocks = range_blocks(iter_gzip(log_file), end - start)
+        if skip_first:
+            # the line started in the previous range
+            blocks = skip_line(blocks)
+        return ENGINES[engine](iter_lines(blocks), error)
+
+
+def imap_bounded(pool, function, items, window, args=()):
+    """Like Pool.imap() but with at most window items in flight."""
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item, ) + args))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def aggregate_gzip(log_path, jobs=1, error=QUANTILE_ERROR, engine='python'):
+    index = load_gzip_index(log_path)
+    if jobs > 1 and index is not None and len(index['members']) > 1:
+        ranges = split_members(index, jobs)
+        logging.info('Parsing {} gzip members of {} in {} ranges'.format(
+            len(index['members']), log_path, len(ranges)
+        ))
+        with multiprocessing.Pool(min(jobs, len(ranges))) as pool:
+            parts = pool.starmap(
+                aggregate_members,
+                [(log_path, ) + member_range + (error, engine)
+                 for member_range in ranges]
+            )
+        return merge_reports(parts)
+    # a single member can only be decompressed serially, the lines are
+    # still parsed in parallel; the member boundaries found on the way
+    # are indexed for the next time
+    new_index = {'members': []}
+    with open(log_path, 'rb') as log_file:
+        blocks = iter_gzip(log_file, new_index)
+        if jobs > 1:
+            with multiprocessing.Pool(jobs) as pool:
+                result = merge_reports(imap_bounded(
+                    pool, aggregate_block, line_blocks(blocks), jobs * 2,
+                    (error, engine)
+                ))
+        else:
+            result = ENGINES[engine](iter_lines(blocks), error)
+    if index is None:
+        if len(new_index['members']) > 1:
+            logging.info('{} has {} gzip members'.format(
+                log_path, len(new_index['members'])
+            ))
+        save_gzip_index(log_path, new_index)
+    return result
+
+
+def merge_reports(parts):
+    """Merge the aggregates of consecutive ranges of the log.
+
+    The sums are integers and the quantiles are merged bucket by bucket,
+    so the result is exactly the one of a single aggregate() over the
+    whole file; URLs keep the order in which they first appear in the log.
+    """
+    report = {}
+    total_requests = 0
+    total_requests_time = 0
+    for part, requests, requests_time in parts:
+        total_requests += requests
+        total_requests_time += requests_time
+        for url, entry in part.items():
+            merged = report.get(url)
+            if merged is None:
+                report[url] = entry
+                continue
+            merged['count'] += entry['count']
+            merged['time_sum'] += entry['time_sum']
+            merged['times'].merge(entry['times'])
+            if entry['time_max'] > merged['time_max']:
+                merged['time_max'] = entry['time_max']
+    return report, total_requests, total_requests_time
+
+
+def create_report(log_path, r_size, jobs=1, error=QUANTILE_ERROR,
+                  engine='python'):
+    if log_path.endswith('gz'):
+        report, total_requests, total_requests_time = aggregate_gzip(
+            log_path, jobs, error, engine
+        )
+    elif jobs > 1:
+        ranges = split_file(log_path, jobs)
+        with multiprocessing.Pool(min(jobs, len(ranges) or 1)) as pool:
+            parts = pool.starmap(
+                aggregate_range,
+                [(log_path, start, end, error, engine)
+                 for start, end in ranges]
+            )
+        report, total_requests, total_requests_time = merge_reports(parts)
+    else:
+        report, total_requests, total_requests_time = ENGINES[engine](
+            read_file(log_path), error
+        )
     return build_statistic(report, total_requests, total_requests_time, r_size)
 
 
@@ -146,6 +678,14 @@ def parse_args():
         '--config', help='Path to the configuration file.',
         default='/usr/local/etc/log_analyzer.conf'
     )
+    parser.add_argument(
+        '--jobs', type=int,
+        help='Number of processes parsing a plain-text log in parallel.'
+    )
+    parser.add_argument(
+        '--engine', choices=sorted(ENGINES),
+        help='Aggregate the requests in pure Python or with numpy.'
+    )
     args = parser.parse_args()
     config_path = args.config
     if config_path is not None:
@@ -156,16 +696,30 @@ def parse_args():
         config = DEFAULT_CONF
     for item in set(DEFAULT_CONF.keys()).difference(set(config.keys())):
         config[item] = DEFAULT_CONF[item]
+    if args.jobs is not None:
+        config['jobs'] = args.jobs
+    if args.engine is not None:
+        config['engine'] = args.engine
     return config
 
 
 def main(config):
     logs_dir = config['log_dir']
     reports_dir = config['report_dir']
-    report_size = config['report_size']
+    report_size = int(config['report_size'])
+    jobs = int(config['jobs'])
+    quantile_error = float(config['quantile_error'])
+    engine = config['engine']
     log_template = 'nginx-access-ui*'
     report_template = 'report-{Y}.{m}.{d}.html'
 
+    if engine not in ENGINES:
+        logging.error('Unknown engine {}!'.format(engine))
+        return
+    if engine == 'numpy' and np is None:
+        logging.error('The numpy engine requires numpy to be installed!')
+        return
+
     if not os.path.exists(logs_dir) or not os.path.exists(reports_dir):
         logging.error('Wrong logs/reports path!')
         return
@@ -180,7 +734,9 @@ def main(config):
     )
     report_path = os.path.join(reports_dir, report_name)
     if not os.path.exists(report_path):
-        report = create_report(log_path, report_size)
+        report = create_report(
+            log_path, report_size, jobs, quantile_error, engine
+        )
         save_report(report, report_path)
     else:
         logging.error('Log {} has already been handled!'.format(log_path))
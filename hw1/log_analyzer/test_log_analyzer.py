@@ -1,8 +1,35 @@
+import glob
+import gzip
+import os
+import random
 import unittest
 from unittest.mock import patch
 from tempfile import TemporaryDirectory, TemporaryFile
 
-from log_analyzer import parse, scan_dir
+from log_analyzer import (
+    Quantiles, create_report, load_gzip_index, np, parse, scan_dir,
+    select_top, split_file
+)
+
+
+LOG_LINE = (
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] '
+    '"GET {url} HTTP/1.1" 200 927 "-" "Lynx/2.8.8dev.9" "-" '
+    '"1498697422-2190034393-4708-9752759" "dc7161be3" {time:.3f}\n'
+)
+
+
+def write_log(path, lines=2000, seed=0):
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(lines):
+            if i % 500 == 7:
+                f.write('not a log line\n')
+                continue
+            f.write(LOG_LINE.format(
+                url='/api/v2/banner/{}'.format(rng.randint(1, 50)),
+                time=rng.expovariate(3)
+            ))
 
 
 class TestLogAnalyzer(unittest.TestCase):
@@ -50,4 +77,112 @@ class TestLogAnalyzer(unittest.TestCase):
             )
 
 
-        
\ No newline at end of file
+        
+
+    def test_split_file(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            write_log(path, lines=100)
+            with open(path, 'rb') as f:
+                data = f.read()
+            for parts in range(1, 12):
+                ranges = split_file(path, parts)
+                self.assertLessEqual(len(ranges), parts)
+                self.assertEqual(
+                    b''.join(data[start:end] for start, end in ranges), data
+                )
+                for start, _ in ranges:
+                    self.assertIn(data[start - 1:start], (b'', b'\n'))
+
+    def test_quantiles(self):
+        rng = random.Random(0)
+        times = [0.0] * 50 + [rng.expovariate(3) for _ in range(10000)]
+        whole = Quantiles(0.01)
+        parts = [Quantiles(0.01) for _ in range(3)]
+        for i, value in enumerate(times):
+            whole.add(value)
+            parts[i % 3].add(value)
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+        fractions = (0, 0.001, 0.5, 0.9, 0.99, 1)
+        self.assertEqual(merged.quantiles(fractions),
+                         whole.quantiles(fractions))
+        times.sort()
+        for fraction, estimate in zip(fractions, whole.quantiles(fractions)):
+            exact = times[int(fraction * (len(times) - 1))]
+            self.assertLessEqual(abs(estimate - exact), exact * 0.01)
+        with self.assertRaises(ValueError):
+            whole.merge(Quantiles(0.02))
+
+    def test_select_top(self):
+        rng = random.Random(0)
+        entries = {
+            str(i): {'time_sum': rng.randint(0, 20)} for i in range(1000)
+        }
+        expected = sorted(entries.values(), key=lambda e: e['time_sum'],
+                          reverse=True)
+        for size in (0, 1, 10, 31, 32, 500, 1000, 2000):
+            result = select_top(entries, size)
+            self.assertEqual(len(result), len(expected[:size]))
+            for entry, expected_entry in zip(result, expected):
+                self.assertIs(entry, expected_entry)
+
+    def test_create_report_jobs(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            write_log(path)
+            serial = create_report(path, 20)
+            for jobs in (2, 3, 8):
+                self.assertEqual(create_report(path, 20, jobs), serial)
+
+    @patch('log_analyzer.GZIP_CHUNK_SIZE', 1000)
+    @patch('log_analyzer.GZIP_BLOCK_SIZE', 5000)
+    def test_create_report_gzip(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            write_log(path)
+            serial = create_report(path, 20)
+            with open(path, 'rb') as f:
+                data = f.read()
+            single = path + '.gz'
+            with open(single, 'wb') as f:
+                f.write(gzip.compress(data))
+            # concatenated members which do not end with a line break
+            multi = os.path.join(tmp, 'nginx-access-ui.log-20170701.gz')
+            with open(multi, 'wb') as f:
+                for start in range(0, len(data), 30001):
+                    f.write(gzip.compress(data[start:start + 30001]))
+            members = len(range(0, len(data), 30001))
+            for log_path, members in ((single, 1), (multi, members)):
+                # the first pass builds the index, the next ones use it
+                for jobs in (1, 3, 4):
+                    self.assertEqual(create_report(log_path, 20, jobs), serial)
+                    index = load_gzip_index(log_path)
+                    self.assertEqual(len(index['members']), members)
+                    self.assertEqual(index['uncompressed_size'], len(data))
+            self.assertEqual(
+                len(glob.glob(os.path.join(tmp, 'nginx-access-ui*'))), 3
+            )
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    @patch('log_analyzer.NUMPY_BATCH_SIZE', 300)
+    def test_create_report_numpy(self):
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'nginx-access-ui.log-20170630')
+            write_log(path)
+            with open(path, 'a', encoding='utf-8') as f:
+                for time in (0, 0):
+                    f.write(LOG_LINE.format(url='/zero', time=time))
+            serial = create_report(path, 100)
+            for jobs in (1, 3):
+                self.assertEqual(
+                    create_report(path, 100, jobs, engine='numpy'), serial
+                )
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data))
+            self.assertEqual(
+                create_report(path + '.gz', 100, 2, engine='numpy'), serial
+            )
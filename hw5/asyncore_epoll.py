@@ -46,11 +46,13 @@ many of the difficult problems for you, making the task of building
 sophisticated high-performance network servers and clients a snap.
 """
 
+import heapq
 import select
 import socket
 import sys
 import time
 import warnings
+from collections import deque
 
 import os
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, EINVAL, \
@@ -122,6 +124,168 @@ def readwrite(obj, flags):
     except:
         obj.handle_error()
 
+class histogram:
+    """Counts of durations in power-of-two microsecond buckets."""
+
+    __slots__ = ('counts', 'total', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * 40
+        self.total = 0
+        self.sum = 0.0
+
+    def add(self, seconds):
+        self.counts[min(int(seconds * 1e6).bit_length(), 39)] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def percentile(self, percent):
+        # upper bound of the bucket, in microseconds
+        rank = self.total * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return 1 << bucket
+        return 0
+
+    def as_dict(self):
+        return {
+            'count': self.total,
+            'mean_us': round(self.sum / self.total * 1e6, 1)
+                       if self.total else 0,
+            'p50_us': self.percentile(50),
+            'p99_us': self.percentile(99),
+            'p999_us': self.percentile(99.9),
+            'buckets_us': {1 << bucket: count
+                           for bucket, count in enumerate(self.counts)
+                           if count},
+        }
+
+class loop_stats:
+    """What loop() and the pollers record when enabled.
+
+    Collection is switched on with enable_stats(); while it is off the
+    only cost is a check of a module global per iteration, event and
+    send()/recv().
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.iterations = 0
+        self.iteration_time = histogram()
+        self.poll_time = histogram()
+        # ready events returned by one poll, in power-of-two buckets
+        self.ready_events = [0] * 24
+        self.events = 0
+        self.handler_time = {
+            'read': histogram(), 'write': histogram(), 'other': histogram()
+        }
+        self.timer_time = histogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def add_events(self, count):
+        self.events += count
+        self.ready_events[min(count.bit_length(), 23)] += 1
+
+    def add_handler(self, flags, seconds):
+        if flags & select.POLLIN:
+            kind = 'read'
+        elif flags & select.POLLOUT:
+            kind = 'write'
+        else:
+            kind = 'other'
+        self.handler_time[kind].add(seconds)
+
+    def as_dict(self):
+        return {
+            'uptime': round(time.time() - self.started, 3),
+            'iterations': self.iterations,
+            'iteration_time': self.iteration_time.as_dict(),
+            'poll_time': self.poll_time.as_dict(),
+            'events': self.events,
+            'ready_events': {(1 << bucket) - 1 if bucket else 0: count
+                             for bucket, count in
+                             enumerate(self.ready_events) if count},
+            'handler_time': {kind: h.as_dict()
+                             for kind, h in self.handler_time.items()},
+            'timer_time': self.timer_time.as_dict(),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+        }
+
+_stats = None
+
+def enable_stats():
+    """Start collecting loop_stats, return the collecting object."""
+    global _stats
+    if _stats is None:
+        _stats = loop_stats()
+    return _stats
+
+def disable_stats():
+    global _stats
+    _stats = None
+
+def get_stats():
+    """Return the loop_stats being collected or None."""
+    return _stats
+
+def _drain(obj, handler, predicate, budget):
+    # Call handler until the channel would block, is closed or is no
+    # longer interested.  Returns True if the budget ran out first, i.e.
+    # the socket may still be ready.
+    for _ in range(budget):
+        if obj._fileno is None or not predicate():
+            return False
+        obj.would_block = False
+        try:
+            handler()
+        except BlockingIOError:
+            return False
+        if obj.would_block:
+            return False
+    return obj._fileno is not None
+
+def readwrite_edge(obj, flags):
+    """Handle an edge-triggered event by draining the socket.
+
+    Returns the part of flags which is still pending because the
+    channel's drain_budget was exhausted.
+    """
+    pending = 0
+    try:
+        if flags & select.POLLIN:
+            if _drain(obj, obj.handle_read_event, obj.readable,
+                      obj.drain_budget):
+                pending |= select.POLLIN
+        if flags & select.POLLOUT:
+            if _drain(obj, obj.handle_write_event, obj.writable,
+                      obj.drain_budget):
+                pending |= select.POLLOUT
+        if flags & select.POLLPRI:
+            obj.handle_expt_event()
+        if flags & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+            if pending:
+                # read what is left before closing
+                pending |= flags & (select.POLLHUP | select.POLLERR |
+                                    select.POLLNVAL)
+            else:
+                obj.handle_close()
+    except socket.error as e:
+        if e.args[0] not in _DISCONNECTED:
+            obj.handle_error()
+        else:
+            obj.handle_close()
+        return 0
+    except _reraised_exceptions:
+        raise
+    except:
+        obj.handle_error()
+        return 0
+    return pending
+
 def select_poller(timeout=0.0, map=None):
     """A poller which uses select(), available on most platforms."""
     if map is None:
@@ -142,28 +306,46 @@ def select_poller(timeout=0.0, map=None):
             time.sleep(timeout)
             return
 
+        stats = _stats
+        if stats is not None:
+            started = time.perf_counter()
         try:
             r, w, e = select.select(r, w, e, timeout)
         except InterruptedError:
             return
+        if stats is not None:
+            stats.poll_time.add(time.perf_counter() - started)
+            stats.add_events(len(r) + len(w) + len(e))
 
         for fd in r:
             obj = map.get(fd)
             if obj is None:
                 continue
+            if stats is not None:
+                started = time.perf_counter()
             read(obj)
+            if stats is not None:
+                stats.add_handler(select.POLLIN, time.perf_counter() - started)
 
         for fd in w:
             obj = map.get(fd)
             if obj is None:
                 continue
+            if stats is not None:
+                started = time.perf_counter()
             write(obj)
+            if stats is not None:
+                stats.add_handler(select.POLLOUT, time.perf_counter() - started)
 
         for fd in e:
             obj = map.get(fd)
             if obj is None:
                 continue
+            if stats is not None:
+                started = time.perf_counter()
             _exception(obj)
+            if stats is not None:
+                stats.add_handler(select.POLLPRI, time.perf_counter() - started)
 
 def poll_poller(timeout=0.0, map=None):
     """A poller which uses poll(), available on most UNIXen."""
@@ -183,15 +365,25 @@ def poll_poller(timeout=0.0, map=None):
                 flags |= select.POLLOUT
             if flags:
                 pollster.register(fd, flags)
+        stats = _stats
+        if stats is not None:
+            started = time.perf_counter()
         try:
             r = pollster.poll(timeout)
         except InterruptedError:
             r = []
+        if stats is not None:
+            stats.poll_time.add(time.perf_counter() - started)
+            stats.add_events(len(r))
         for fd, flags in r:
             obj = map.get(fd)
             if obj is None:
                 continue
+            if stats is not None:
+                started = time.perf_counter()
             readwrite(obj, flags)
+            if stats is not None:
+                stats.add_handler(flags, time.perf_counter() - started)
 
 # Aliases for backward compatibility
 poll = select_poller
@@ -201,9 +393,9 @@ def epoll_poller(timeout=0.0, map=None):
     """A poller which uses epoll(), supported on Linux 2.5.44 and newer."""
     if map is None:
         map = socket_map
-    pollster = select.epoll()
     if map:
-        for fd, obj in map.items():
+        pollster = select.epoll()
+        for fd, obj in list(map.items()):
             flags = 0
             if obj.readable():
                 flags |= select.POLLIN | select.POLLPRI
@@ -214,17 +406,172 @@ def epoll_poller(timeout=0.0, map=None):
                 # or writable.
                 flags |= select.POLLERR | select.POLLHUP | select.POLLNVAL
                 pollster.register(fd, flags)
+        stats = _stats
+        if stats is not None:
+            started = time.perf_counter()
         try:
             r = pollster.poll(timeout)
-        except select.error, err:
-            if err.args[0] != EINTR:
-                raise
+        except InterruptedError:
             r = []
+        finally:
+            pollster.close()
+        if stats is not None:
+            stats.poll_time.add(time.perf_counter() - started)
+            stats.add_events(len(r))
         for fd, flags in r:
             obj = map.get(fd)
             if obj is None:
                 continue
-            readwrite(obj, flags) 
+            if stats is not None:
+                started = time.perf_counter()
+            readwrite(obj, flags)
+            if stats is not None:
+                stats.add_handler(flags, time.perf_counter() - started)
+
+class epoll_pollster:
+    """A long-lived epoll() object bound to a single socket map.
+
+    Unlike epoll_poller(), which rebuilds the whole interest set on every
+    iteration, channels are registered once by dispatcher.add_channel() and
+    unregistered by dispatcher.del_channel().  The readable()/writable()
+    predicates are only re-evaluated for channels which have just handled
+    an event or which called dispatcher.interest_changed(), so the cost of
+    an iteration is proportional to the number of ready channels rather
+    than to the size of the map.
+    """
+
+    def __init__(self, map):
+        self.map = map
+        self.epoll = select.epoll()
+        # fd -> event mask currently known to the kernel
+        self.registered = {}
+        # fds whose event mask has to be (re)computed before polling
+        self.dirty = set(map)
+        # fd -> flags of edge-triggered events left over when a channel
+        # ran out of its drain_budget
+        self.pending = {}
+
+    def register(self, fd):
+        self.dirty.add(fd)
+
+    def unregister(self, fd):
+        self.dirty.discard(fd)
+        self.pending.pop(fd, None)
+        if self.registered.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (OSError, ValueError):
+                # the fd has already been closed and so dropped by the kernel
+                pass
+
+    def flags(self, obj):
+        flags = 0
+        if obj.readable():
+            flags |= select.EPOLLIN | select.EPOLLPRI
+        # accepting sockets should not be writable
+        if obj.writable() and not obj.accepting:
+            flags |= select.EPOLLOUT
+        if flags and obj.edge_triggered:
+            flags |= select.EPOLLET
+        return flags
+
+    def update(self):
+        dirty, self.dirty = self.dirty, set()
+        for fd in dirty:
+            obj = self.map.get(fd)
+            if obj is None:
+                continue
+            flags = self.flags(obj)
+            current = self.registered.get(fd)
+            if current == flags:
+                continue
+            try:
+                if current is None:
+                    self.epoll.register(fd, flags)
+                else:
+                    self.epoll.modify(fd, flags)
+            except FileExistsError:
+                self.epoll.modify(fd, flags)
+            except FileNotFoundError:
+                # the fd was closed and reused behind our back
+                self.epoll.register(fd, flags)
+            self.registered[fd] = flags
+
+    def poll(self, timeout=0.0):
+        self.update()
+        pending, self.pending = self.pending, {}
+        if pending or timeout is None:
+            # channels with leftover events must not wait for new ones
+            timeout = 0 if pending else -1
+        stats = _stats
+        if stats is not None:
+            started = time.perf_counter()
+        try:
+            r = self.epoll.poll(timeout)
+        except InterruptedError:
+            r = []
+        if stats is not None:
+            stats.poll_time.add(time.perf_counter() - started)
+            stats.add_events(len(r))
+        if pending:
+            for fd, flags in r:
+                pending[fd] = pending.get(fd, 0) | flags
+            r = pending.items()
+        map = self.map
+        dirty = self.dirty
+        for fd, flags in r:
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            if stats is not None:
+                started = time.perf_counter()
+            if obj.edge_triggered:
+                left = readwrite_edge(obj, flags)
+                if left and fd in map:
+                    self.pending[fd] = left
+            else:
+                readwrite(obj, flags)
+            if stats is not None:
+                stats.add_handler(flags, time.perf_counter() - started)
+            # handlers are the usual place where the predicates change
+            if fd in map:
+                dirty.add(fd)
+
+    def close(self):
+        self.registered.clear()
+        self.dirty.clear()
+        self.epoll.close()
+
+# map id -> (map, epoll_pollster)
+_pollsters = {}
+
+def get_epoll_pollster(map=None):
+    """Return the persistent epoll_pollster of the map, creating it once."""
+    if map is None:
+        map = socket_map
+    entry = _pollsters.get(id(map))
+    if entry is None or entry[0] is not map:
+        entry = _pollsters[id(map)] = (map, epoll_pollster(map))
+    return entry[1]
+
+def _find_pollster(map):
+    entry = _pollsters.get(id(map))
+    if entry is not None and entry[0] is map:
+        return entry[1]
+
+def persistent_epoll_poller(timeout=0.0, map=None):
+    """A poller which keeps one epoll() object registered across calls."""
+    if map is None:
+        map = socket_map
+    if map:
+        get_epoll_pollster(map).poll(timeout)
+
+def close_epoll_pollster(map=None):
+    if map is None:
+        map = socket_map
+    entry = _pollsters.pop(id(map), None)
+    if entry is not None:
+        entry[1].close()
 
 def kqueue_poller(timeout=0.0, map=None):
     """A poller which uses kqueue(), BSD specific."""
@@ -245,19 +592,134 @@ def kqueue_poller(timeout=0.0, map=None):
                 kqueue.control([ev], 0)
                 selectables += 1
 
+        stats = _stats
+        if stats is not None:
+            started = time.perf_counter()
         events = kqueue.control(None, selectables, timeout)
+        if stats is not None:
+            stats.poll_time.add(time.perf_counter() - started)
+            stats.add_events(len(events))
         for event in events:
             fd = event.ident
             obj = map.get(fd)            
             if obj is None:
                 continue
+            if stats is not None:
+                started = time.perf_counter()
+            ready = 0
             if event.filter == select.KQ_FILTER_READ:
                 read(obj)
+                ready = select.POLLIN
             if event.filter == select.KQ_FILTER_WRITE:
                 write(obj)
+                ready = select.POLLOUT
+            if stats is not None:
+                stats.add_handler(ready, time.perf_counter() - started)
         kqueue.close()
 
 
+class timer:
+    """A scheduled callback, returned by scheduler.call_later()."""
+
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled', 'scheduler')
+
+    def __init__(self, deadline, callback, args, scheduler):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = scheduler
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            self.scheduler.cancelled += 1
+
+class scheduler:
+    """Timers of one socket map kept in a heap ordered by deadline.
+
+    Adding a timer is O(log n), cancelling is O(1): cancelled timers stay
+    in the heap until they reach its top or until they make up more than
+    half of it.  An iteration of loop() only peeks at the earliest deadline
+    to compute the poll timeout and then runs the expired timers.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def call_at(self, deadline, callback, *args):
+        t = timer(deadline, callback, args, self)
+        heapq.heappush(self.heap, t)
+        return t
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def _pop_cancelled(self):
+        heap = self.heap
+        if self.cancelled * 2 > len(heap) > 64:
+            heap[:] = [t for t in heap if not t.cancelled]
+            heapq.heapify(heap)
+            self.cancelled = 0
+        while heap and heap[0].cancelled:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+
+    def timeout(self, timeout):
+        """Shorten the poll timeout so that it ends at the next deadline."""
+        self._pop_cancelled()
+        if not self.heap:
+            return timeout
+        delay = max(0.0, self.heap[0].deadline - time.monotonic())
+        if timeout is None or timeout < 0:
+            return delay
+        return min(timeout, delay)
+
+    def run(self):
+        """Call the expired timers, return how many were called."""
+        heap = self.heap
+        now = time.monotonic()
+        called = 0
+        while heap and heap[0].deadline <= now:
+            t = heapq.heappop(heap)
+            if t.cancelled:
+                self.cancelled -= 1
+                continue
+            # a fired timer can not be cancelled any more
+            t.cancelled = True
+            called += 1
+            try:
+                t.callback(*t.args)
+            except _reraised_exceptions:
+                raise
+            except:
+                nil, exc_type, v, tbinfo = compact_traceback()
+                print('error: uncaptured python exception in timer '
+                      '(%s:%s %s)' % (exc_type, v, tbinfo))
+        return called
+
+# map id -> (map, scheduler)
+_schedulers = {}
+
+def get_scheduler(map=None):
+    """Return the timers of the map, creating them once."""
+    if map is None:
+        map = socket_map
+    entry = _schedulers.get(id(map))
+    if entry is None or entry[0] is not map:
+        entry = _schedulers[id(map)] = (map, scheduler())
+    return entry[1]
+
+def call_later(delay, callback, *args, map=None):
+    return get_scheduler(map).call_later(delay, callback, *args)
+
 def loop(timeout=30.0, use_poll=False, map=None, count=None, 
          poller=select_poller):
     if map is None:
@@ -265,36 +727,76 @@ def loop(timeout=30.0, use_poll=False, map=None, count=None,
     # code which grants backward compatibility with "use_poll" 
     # argument which should no longer be used in favor of
     # "poller"
-    if use_poll and hasattr(select, 'poll'):
-        poller = poll_poller
-    else:
-        poller = select_poller
+    if use_poll:
+        if hasattr(select, 'poll'):
+            poller = poll_poller
+        else:
+            poller = select_poller
 
+    timers = get_scheduler(map)
     if count is None:
         while map:
-            poller(timeout, map)
+            _iterate(poller, timers, timeout, map)
     else:
         while map and count > 0:
-            poller(timeout, map)
+            _iterate(poller, timers, timeout, map)
             count = count - 1
 
+def _iterate(poller, timers, timeout, map):
+    stats = _stats
+    if stats is None:
+        poller(timers.timeout(timeout), map)
+        timers.run()
+        return
+    started = time.perf_counter()
+    poller(timers.timeout(timeout), map)
+    polled = time.perf_counter()
+    called = timers.run()
+    finished = time.perf_counter()
+    stats.iterations += 1
+    stats.iteration_time.add(finished - started)
+    if called:
+        stats.timer_time.add(finished - polled)
+
 class dispatcher:
 
+    # The state of a channel lives in slots.  '__dict__' keeps arbitrary
+    # attributes of subclasses working; it is only allocated once such an
+    # attribute is set, so a subclass declaring __slots__ for all of its
+    # attributes has no per-instance dict.
+    __slots__ = ('_map', '_fileno', 'socket', 'connected', 'accepting',
+                 'connecting', 'closing', 'addr', 'would_block', '_timers',
+                 'bytes_in', 'bytes_out', '__dict__', '__weakref__')
+
     debug = False
-    connected = False
-    accepting = False
-    connecting = False
-    closing = False
-    addr = None
     ignore_log_types = frozenset(['warning'])
-
-    def __init__(self, sock=None, map=None):
+    # With the persistent epoll poller an edge-triggered channel is
+    # registered with EPOLLET and its handlers are called repeatedly on
+    # every event, up to drain_budget times, until the socket would block.
+    # Handlers must therefore consume the socket with recv()/send()/accept()
+    # (or let BlockingIOError propagate) instead of doing a single read.
+    edge_triggered = False
+    drain_budget = 16
+
+    def __init__(self, sock=None, map=None, addr=None):
         if map is None:
             self._map = socket_map
         else:
             self._map = map
 
+        # set first: __getattr__() delegates to it
+        self.socket = None
         self._fileno = None
+        self.connected = False
+        self.accepting = False
+        self.connecting = False
+        self.closing = False
+        self.addr = None
+        self.would_block = False
+        self._timers = None
+        # traffic of the channel, counted while stats are enabled
+        self.bytes_in = 0
+        self.bytes_out = 0
 
         if sock:
             # Set to nonblocking just to make sure for cases where we
@@ -302,6 +804,10 @@ class dispatcher:
             sock.setblocking(0)
             self.set_socket(sock, map)
             self.connected = True
+            if addr is not None:
+                # the peer address is already known from accept()
+                self.addr = addr
+                return
             # The constructor no longer requires that the socket
             # passed be connected.
             try:
@@ -317,8 +823,6 @@ class dispatcher:
                     # polling of broken sockets).
                     self.del_channel(map)
                     raise
-        else:
-            self.socket = None
 
     def __repr__(self):
         status = [self.__class__.__module__+"."+self.__class__.__name__]
@@ -340,6 +844,9 @@ class dispatcher:
         if map is None:
             map = self._map
         map[self._fileno] = self
+        pollster = _find_pollster(map)
+        if pollster is not None:
+            pollster.register(self._fileno)
 
     def del_channel(self, map=None):
         fd = self._fileno
@@ -348,8 +855,45 @@ class dispatcher:
         if fd in map:
             #self.log_info('closing channel %d:%s' % (fd, self))
             del map[fd]
+            pollster = _find_pollster(map)
+            if pollster is not None:
+                pollster.unregister(fd)
         self._fileno = None
 
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) after delay seconds, unless cancelled.
+
+        The returned timer is cancelled automatically when the channel is
+        closed.
+        """
+        t = get_scheduler(self._map).call_later(
+            delay, self._run_timer, callback, args
+        )
+        if self._timers is None:
+            self._timers = set()
+        self._timers.add(t)
+        return t
+
+    def cancel(self, t):
+        t.cancel()
+        if self._timers is not None:
+            self._timers.discard(t)
+
+    def _run_timer(self, callback, args):
+        for t in list(self._timers):
+            if t.cancelled:
+                self._timers.discard(t)
+        callback(*args)
+
+    def interest_changed(self):
+        # readable()/writable() are only re-evaluated by the persistent
+        # epoll poller after this channel handled an event; call this when
+        # they change for any other reason (e.g. data queued from another
+        # channel).
+        pollster = _find_pollster(self._map)
+        if pollster is not None and self._fileno is not None:
+            pollster.register(self._fileno)
+
     def create_socket(self, family=socket.AF_INET, type=socket.SOCK_STREAM):
         self.family_and_type = family, type
         sock = socket.socket(family, type)
@@ -420,7 +964,10 @@ class dispatcher:
         except TypeError:
             return None
         except socket.error as why:
-            if why.args[0] in (EWOULDBLOCK, ECONNABORTED, EAGAIN):
+            if why.args[0] in (EWOULDBLOCK, EAGAIN):
+                self.would_block = True
+                return None
+            elif why.args[0] == ECONNABORTED:
                 return None
             else:
                 raise
@@ -430,9 +977,15 @@ class dispatcher:
     def send(self, data):
         try:
             result = self.socket.send(data)
+            if result < len(data):
+                # the socket buffer is full, the next send() would block
+                self.would_block = True
+            if _stats is not None:
+                self.count_sent(result)
             return result
         except socket.error as why:
             if why.args[0] == EWOULDBLOCK:
+                self.would_block = True
                 return 0
             elif why.args[0] in _DISCONNECTED:
                 self.handle_close()
@@ -440,6 +993,38 @@ class dispatcher:
             else:
                 raise
 
+    def sendmsg(self, buffers, flags=0):
+        # scatter-gather version of send(): writes all the buffers with a
+        # single syscall, returns the number of bytes sent
+        try:
+            result = self.socket.sendmsg(buffers, (), flags)
+            if _stats is not None:
+                self.count_sent(result)
+            return result
+        except socket.error as why:
+            if why.args[0] == EWOULDBLOCK:
+                self.would_block = True
+                return 0
+            elif why.args[0] in _DISCONNECTED:
+                self.handle_close()
+                return 0
+            else:
+                raise
+
+    def count_sent(self, num_sent):
+        # for subclasses writing to the socket directly (e.g. sendfile)
+        stats = _stats
+        if stats is not None:
+            self.bytes_out += num_sent
+            stats.bytes_out += num_sent
+
+    def count_received(self, num_received):
+        # for subclasses reading from the socket directly
+        stats = _stats
+        if stats is not None:
+            self.bytes_in += num_received
+            stats.bytes_in += num_received
+
     def recv(self, buffer_size):
         try:
             data = self.socket.recv(buffer_size)
@@ -449,6 +1034,8 @@ class dispatcher:
                 self.handle_close()
                 return b''
             else:
+                if _stats is not None:
+                    self.count_received(len(data))
                 return data
         except socket.error as why:
             # winsock sometimes raises ENOTCONN
@@ -462,6 +1049,10 @@ class dispatcher:
         self.connected = False
         self.accepting = False
         self.connecting = False
+        if self._timers:
+            for t in self._timers:
+                t.cancel()
+            self._timers = None
         self.del_channel()
         try:
             self.socket.close()
@@ -592,26 +1183,74 @@ class dispatcher:
 
 class dispatcher_with_send(dispatcher):
 
+    __slots__ = ('out_buffer', 'out_buffer_size', 'paused', 'bytes_queued',
+                 'bytes_sent')
+
+    # largest chunk passed to a single send()
+    max_write_size = 64 * 1024
+    # reading is paused while more than high_watermark bytes are queued and
+    # resumed once the queue drains to low_watermark; subclasses overriding
+    # readable() should honour self.paused
+    high_watermark = 1024 * 1024
+    low_watermark = 256 * 1024
+
     def __init__(self, sock=None, map=None):
         dispatcher.__init__(self, sock, map)
-        self.out_buffer = b''
+        # queued data as memoryviews, so a partial send only moves an offset
+        self.out_buffer = deque()
+        self.out_buffer_size = 0
+        self.paused = False
+        self.bytes_queued = 0
+        self.bytes_sent = 0
 
     def initiate_send(self):
-        num_sent = 0
-        num_sent = dispatcher.send(self, self.out_buffer[:512])
-        self.out_buffer = self.out_buffer[num_sent:]
+        # only a short send() of this call may stop it, on level-triggered
+        # channels nothing else clears the flag
+        self.would_block = False
+        out_buffer = self.out_buffer
+        while out_buffer:
+            data = out_buffer[0]
+            num_sent = dispatcher.send(self, data[:self.max_write_size])
+            if not num_sent:
+                break
+            self.bytes_sent += num_sent
+            self.out_buffer_size -= num_sent
+            if num_sent < len(data):
+                out_buffer[0] = data[num_sent:]
+                if self.would_block:
+                    break
+            else:
+                out_buffer.popleft()
+        if self.paused and self.out_buffer_size <= self.low_watermark:
+            self.paused = False
 
     def handle_write(self):
         self.initiate_send()
 
+    def readable(self):
+        return not self.paused
+
     def writable(self):
-        return (not self.connected) or len(self.out_buffer)
+        return (not self.connected) or bool(self.out_buffer)
 
     def send(self, data):
         if self.debug:
             self.log_info('sending %s' % repr(data))
-        self.out_buffer = self.out_buffer + data
+        if not data:
+            return
+        if not isinstance(data, bytes):
+            # the caller may reuse a mutable buffer
+            data = bytes(data)
+        was_empty = not self.out_buffer
+        self.out_buffer.append(memoryview(data))
+        self.out_buffer_size += len(data)
+        self.bytes_queued += len(data)
+        if not self.paused and self.out_buffer_size > self.high_watermark:
+            self.paused = True
         self.initiate_send()
+        if was_empty or self.paused:
+            # send() may be called from the handlers of another channel
+            self.interest_changed()
 
 # ---------------------------------------------------------------------------
 # used for debugging.
@@ -654,6 +1293,7 @@ def close_all(map=None, ignore_all=False):
             if not ignore_all:
                 raise
     map.clear()
+    close_epoll_pollster(map)
 
 # Asynchronous File I/O:
 #
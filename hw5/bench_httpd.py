@@ -0,0 +1,298 @@
+"""Load test of httpd.py on localhost.
+
+Starts httpd.py once per poller (and backend) and drives it from several
+client processes, each running many connections on its own asyncio loop,
+with keep-alive and non-keep-alive GET/HEAD traffic. Reports requests per
+second and latency percentiles, and writes the results to JSON so runs can
+be compared for regressions:
+
+    python bench_httpd.py -r /var/www -u /index.html -c 100 -d 10 -o out.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+HTTPD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'httpd.py')
+POLLERS = ('select', 'poll', 'epoll', 'persistent-epoll')
+
+
+class Histogram:
+    """Log-bucketed latency histogram with a bounded relative error.
+
+    Histograms of the client processes are merged by adding the counts.
+    """
+
+    def __init__(self, precision=0.01):
+        self.base = math.log1p(precision)
+        self.counts = {}
+        self.total = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = int(math.log(max(seconds, 1e-7) * 1e6) / self.base)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Return the latency in milliseconds below which percent fall."""
+        if not self.total:
+            return None
+        rank = math.ceil(self.total * percent / 100)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return round(math.exp((bucket + 1) * self.base) / 1000, 3)
+
+
+def build_request(method, path, keep_alive):
+    return (
+        '{} {} HTTP/1.1\r\nHost: localhost\r\nConnection: {}\r\n\r\n'
+    ).format(
+        method, path, 'keep-alive' if keep_alive else 'close'
+    ).encode('latin-1')
+
+
+async def read_response(reader, method):
+    head = await reader.readuntil(b'\r\n\r\n')
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.lower() == b'content-length':
+            length = int(value)
+    if method != 'HEAD' and length:
+        await reader.readexactly(length)
+    return head[9:12]
+
+
+async def run_connection(host, port, request, method, keep_alive, deadline,
+                         histogram, stats):
+    reader = writer = None
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(request)
+            status = await read_response(reader, method)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            stats['errors'] += 1
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            continue
+        histogram.add(time.monotonic() - started)
+        if status != b'200':
+            stats['errors'] += 1
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+def client_process(host, port, path, method, keep_alive, connections,
+                   duration):
+    """Run connections for duration seconds, return (histogram, errors)."""
+    histogram = Histogram()
+    stats = {'errors': 0}
+    request = build_request(method, path, keep_alive)
+    deadline = time.monotonic() + duration
+
+    async def run():
+        await asyncio.gather(*(
+            run_connection(host, port, request, method, keep_alive,
+                           deadline, histogram, stats)
+            for _ in range(connections)
+        ))
+
+    asyncio.run(run())
+    return histogram, stats['errors']
+
+
+def start_server(port, root, poller, backend, extra_args=()):
+    process = subprocess.Popen(
+        [sys.executable, HTTPD, '--host', '127.0.0.1', '-p', str(port),
+         '-r', root, '--poller', poller, '--backend', backend] +
+        list(extra_args),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('httpd.py did not start on port {}'.format(port))
+
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_case(pool, args, method, keep_alive):
+    per_process = [
+        args.concurrency // args.processes +
+        (1 if i < args.concurrency % args.processes else 0)
+        for i in range(args.processes)
+    ]
+    started = time.monotonic()
+    results = pool.starmap(client_process, [
+        ('127.0.0.1', args.port, args.url, method, keep_alive, connections,
+         args.duration)
+        for connections in per_process if connections
+    ])
+    elapsed = time.monotonic() - started
+    histogram = Histogram()
+    errors = 0
+    for process_histogram, process_errors in results:
+        histogram.merge(process_histogram)
+        errors += process_errors
+    return {
+        'method': method,
+        'keep_alive': keep_alive,
+        'requests': histogram.total,
+        'errors': errors,
+        'rps': round(histogram.total / elapsed, 1),
+        'latency_ms': {
+            'p50': histogram.percentile(50),
+            'p99': histogram.percentile(99),
+            'p999': histogram.percentile(99.9),
+            'max': round(histogram.max * 1000, 3),
+        },
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-r', '--root',
+        help='Directory served by httpd.py; by default a temporary one '
+             'with a --size bytes index.html.'
+    )
+    parser.add_argument('-u', '--url', default='/index.html')
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('-p', '--port', type=int, default=18080)
+    parser.add_argument(
+        '--pollers', default=','.join(POLLERS),
+        help='Comma separated pollers of the asyncore backend.'
+    )
+    parser.add_argument(
+        '--backends', default='asyncore',
+        help='Comma separated backends, "asyncio" ignores --pollers.'
+    )
+    parser.add_argument('--methods', default='GET,HEAD')
+    parser.add_argument(
+        '--modes', default='keep-alive,close',
+        help='Comma separated connection modes: keep-alive, close.'
+    )
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument(
+        '--processes', type=int, default=os.cpu_count() or 1,
+        help='Client processes the connections are spread over.'
+    )
+    parser.add_argument('-d', '--duration', type=float, default=5.0)
+    parser.add_argument('-o', '--output', help='Write the results as JSON.')
+    parser.add_argument(
+        'server_args', nargs=argparse.REMAINDER,
+        help='Extra httpd.py arguments after "--".'
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server_args = [arg for arg in args.server_args if arg != '--']
+    root = args.root
+    tmp = None
+    if root is None:
+        tmp = tempfile.TemporaryDirectory()
+        root = tmp.name
+        with open(os.path.join(root, args.url.lstrip('/')), 'wb') as f:
+            f.write(os.urandom(args.size))
+
+    targets = []
+    for backend in args.backends.split(','):
+        if backend == 'asyncio':
+            targets.append((backend, 'persistent-epoll'))
+        else:
+            targets.extend(
+                (backend, poller) for poller in args.pollers.split(',')
+            )
+
+    results = []
+    pool = multiprocessing.Pool(args.processes)
+    try:
+        for backend, poller in targets:
+            server = start_server(args.port, root, poller, backend,
+                                  server_args)
+            try:
+                for mode in args.modes.split(','):
+                    for method in args.methods.split(','):
+                        result = run_case(
+                            pool, args, method, mode == 'keep-alive'
+                        )
+                        result.update(backend=backend, poller=poller)
+                        results.append(result)
+                        print('{backend:9} {poller:16} {mode:10} {method:4} '
+                              '{rps:>10} rps  p50 {p50} ms  p99 {p99} ms  '
+                              'p999 {p999} ms  errors {errors}'.format(
+                                  backend=backend, poller=poller, mode=mode,
+                                  method=method, rps=result['rps'],
+                                  errors=result['errors'],
+                                  **result['latency_ms']))
+            finally:
+                stop_server(server)
+    finally:
+        pool.close()
+        pool.join()
+        if tmp is not None:
+            tmp.cleanup()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                'meta': {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'cpus': os.cpu_count(),
+                    'url': args.url,
+                    'concurrency': args.concurrency,
+                    'processes': args.processes,
+                    'duration': args.duration,
+                    'server_args': server_args,
+                },
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
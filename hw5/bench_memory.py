@@ -0,0 +1,103 @@
+"""Memory footprint of idle httpd.py connections.
+
+Opens N socket pairs, wraps one end of each in a RequestHandler of an
+HTTPServer (as if it had been accepted) and reports the Python memory
+allocated per connection, measured with tracemalloc, and the growth of the
+resident set size. Optionally every connection first serves one keep-alive
+request so the parser buffer and response queue have been used:
+
+    python bench_memory.py -n 10000 --requests 1
+"""
+import argparse
+import gc
+import os
+import resource
+import socket
+import sys
+import tempfile
+import tracemalloc
+
+import asyncore_epoll as asyncore
+import httpd
+
+
+def rss():
+    """Return the resident set size in bytes."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def open_connections(server, count, requests):
+    pairs = []
+    for _ in range(count):
+        ours, theirs = socket.socketpair()
+        handler = httpd.RequestHandler(ours, server, server._map)
+        pairs.append((handler, theirs))
+    for _ in range(requests):
+        waiting = []
+        for _, theirs in pairs:
+            theirs.send(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            theirs.setblocking(False)
+            waiting.append(theirs)
+        # let the handlers read, answer and go back to keep-alive
+        while waiting:
+            asyncore.persistent_epoll_poller(0.1, server._map)
+            waiting = [theirs for theirs in waiting if not received(theirs)]
+    return pairs
+
+
+def received(sock):
+    try:
+        return bool(sock.recv(65536))
+    except BlockingIOError:
+        return False
+
+
+def measure(count, requests, root):
+    map = {}
+    server = httpd.HTTPServer(('127.0.0.1', 0), 128, map=map,
+                              static_dir=root)
+    gc.collect()
+    tracemalloc.start()
+    rss_before = rss()
+    traced_before = tracemalloc.get_traced_memory()[0]
+    pairs = open_connections(server, count, requests)
+    gc.collect()
+    traced = tracemalloc.get_traced_memory()[0] - traced_before
+    grown = rss() - rss_before
+    tracemalloc.stop()
+    for handler, theirs in pairs:
+        handler.close()
+        theirs.close()
+    server.close()
+    asyncore.close_all(map)
+    return traced / count, grown / count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--connections', type=int, default=10000)
+    parser.add_argument(
+        '--requests', type=int, default=0,
+        help='Keep-alive requests served by every connection first.'
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.connections * 2 + 64 > hard:
+        sys.exit('open files limit {} is too low for {} connections'.format(
+            hard, args.connections))
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'index.html'), 'wb') as f:
+            f.write(b'<html></html>\n')
+        traced, grown = measure(args.connections, args.requests, root)
+    print('{} connections: {:.0f} bytes traced, {:.0f} bytes RSS per '
+          'connection'.format(args.connections, traced, grown))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Microbenchmark of the asyncore_epoll pollers.
+
+Opens N socket pairs, registers one end of each as a dispatcher, makes a
+fraction of them readable before every iteration and measures how long a
+single poller call takes (wall clock and CPU) for every poller and every
+connection count:
+
+    python bench_pollers.py -n 100,1000,10000,50000 -a 0.01 --csv out.csv
+
+Connection counts above the open files limit are skipped, select() is
+skipped for descriptors it can not handle (FD_SETSIZE).
+"""
+import argparse
+import csv
+import gc
+import resource
+import socket
+import statistics
+import sys
+import time
+
+import asyncore_epoll as asyncore
+
+
+POLLERS = {
+    'select': asyncore.select_poller,
+    'poll': asyncore.poll_poller,
+    'epoll': asyncore.epoll_poller,
+    'persistent-epoll': asyncore.persistent_epoll_poller,
+}
+FD_SETSIZE = 1024
+FIELDS = ('poller', 'connections', 'active', 'iterations', 'mean_us',
+          'p50_us', 'p99_us', 'cpu_us')
+
+
+class Reader(asyncore.dispatcher):
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+
+def raise_nofile_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def measure(poller, connections, active, iterations):
+    map = {}
+    pairs = [socket.socketpair() for _ in range(connections)]
+    try:
+        for ours, _ in pairs:
+            Reader(ours, map)
+        step = max(1, int(1 / active)) if active else 0
+        writers = [theirs for _, theirs in pairs[::step]] if step else []
+        # the first call of the persistent poller registers everything
+        poller(0.0, map)
+        wall = []
+        cpu = 0.0
+        gc.disable()
+        for _ in range(iterations):
+            for sock in writers:
+                sock.send(b'x')
+            cpu_started = time.process_time()
+            started = time.perf_counter()
+            poller(0.0, map)
+            wall.append(time.perf_counter() - started)
+            cpu += time.process_time() - cpu_started
+        gc.enable()
+    finally:
+        asyncore.close_all(map)
+        for _, theirs in pairs:
+            theirs.close()
+    wall.sort()
+    return {
+        'active': len(writers),
+        'iterations': iterations,
+        'mean_us': round(statistics.mean(wall) * 1e6, 1),
+        'p50_us': round(wall[len(wall) // 2] * 1e6, 1),
+        'p99_us': round(wall[min(len(wall) - 1, len(wall) * 99 // 100)] *
+                        1e6, 1),
+        'cpu_us': round(cpu / iterations * 1e6, 1),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-n', '--connections', default='100,1000,10000,50000',
+        help='Comma separated numbers of socket pairs.'
+    )
+    parser.add_argument(
+        '-a', '--active', type=float, default=0.01,
+        help='Fraction of the connections made readable per iteration.'
+    )
+    parser.add_argument('-i', '--iterations', type=int, default=200)
+    parser.add_argument(
+        '--pollers', default=','.join(POLLERS),
+        help='Comma separated pollers: ' + ', '.join(POLLERS) + '.'
+    )
+    parser.add_argument('--csv', help='Write the results to this file.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    limit = raise_nofile_limit()
+    rows = []
+    print('{:16} {:>11} {:>7} {:>10} {:>10} {:>10} {:>10}'.format(
+        'poller', 'connections', 'active', 'mean us', 'p50 us', 'p99 us',
+        'cpu us'))
+    for connections in map(int, args.connections.split(',')):
+        # two descriptors per pair plus some slack for the interpreter
+        if connections * 2 + 32 > limit:
+            print('skipping {} connections: open files limit is {}'.format(
+                connections, limit), file=sys.stderr)
+            continue
+        for name in args.pollers.split(','):
+            if name == 'select' and connections * 2 + 16 > FD_SETSIZE:
+                continue
+            row = measure(POLLERS[name], connections, args.active,
+                          args.iterations)
+            row.update(poller=name, connections=connections)
+            rows.append(row)
+            print('{poller:16} {connections:>11} {active:>7} {mean_us:>10} '
+                  '{p50_us:>10} {p99_us:>10} {cpu_us:>10}'.format(**row))
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,529 @@
+import argparse
+import asyncio
+import json
+import logging
+import mimetypes
 import os
+import resource
+import signal
 import socket
-from collections import deque
+import sys
+import time
+from collections import OrderedDict
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from errno import EMFILE, ENFILE, ENOBUFS, ENOMEM
+from stat import S_ISREG
+from urllib.parse import unquote
 
 import asyncore_epoll as asyncore
 
 
-class RequestHandler(asyncore.dispatcher):
+_date = [None, '']
+
+
+def http_date():
+    """Return the Date header value, formatted once per second."""
+    now = int(time.time())
+    if now != _date[0]:
+        _date[:] = now, formatdate(now, usegmt=True)
+    return _date[1]
+
+
+class CachedFile:
+    """An open static file with the metadata needed for its headers.
+
+    The descriptor is shared by every response streaming the file
+    (os.sendfile() does not move the file position) and is closed once
+    the cache and all of those responses have released it.
+    """
+
+    def __init__(self, url_path, path, file, stat, content_type):
+        self.url_path = url_path
+        self.path = path
+        self.file = file
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.identity = (stat.st_dev, stat.st_ino, stat.st_size,
+                         stat.st_mtime_ns)
+        self.etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.content_type = content_type
+        self.checked = time.monotonic()
+        self.refs = 1
+        # (method, keep_alive) -> (date, complete serialized response)
+        self.rendered = {}
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def acquire(self):
+        self.refs += 1
+        return self
+
+    def release(self):
+        self.refs -= 1
+        if not self.refs:
+            self.file.close()
+
+
+class FileCache:
+    """LRU cache of open static files keyed by the request path.
+
+    A hit costs no filesystem syscalls at all; entries older than ttl
+    seconds are revalidated with a single stat() and reopened when the
+    file was changed or replaced.  Every entry holds a descriptor, so the
+    cache keeps at most descriptor_share of RLIMIT_NOFILE of them.
+    """
+
+    index_file = 'index.html'
+    # the rest of the descriptors is left for the connections
+    descriptor_share = 0.5
+
+    def __init__(self, static_dir, max_entries=1024, ttl=1.0,
+                 render_limit=16 * 1024, render_budget=16 * 1024 * 1024):
+        self.static_dir = os.path.realpath(static_dir)
+        self.max_entries = min(max_entries, self.descriptor_limit())
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # files up to render_limit bytes keep whole pre-rendered responses,
+        # at most render_budget bytes of them in total
+        self.render_limit = render_limit
+        self.render_budget = render_budget
+        self.rendered_size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def descriptor_limit(self):
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY:
+            return sys.maxsize
+        return max(1, int(soft * self.descriptor_share))
+
+    def resolve(self, url_path):
+        """Map the request path to a file inside static_dir."""
+        path = os.path.realpath(
+            os.path.join(self.static_dir, url_path.lstrip('/'))
+        )
+        if path != self.static_dir and \
+                not path.startswith(self.static_dir + os.sep):
+            raise PermissionError(url_path)
+        if os.path.isdir(path):
+            path = os.path.join(path, self.index_file)
+        return path
+
+    def get(self, url_path):
+        """Return an acquired CachedFile, the caller has to release it.
+
+        Raises PermissionError for paths outside of static_dir and
+        OSError when the file can not be opened.  When the process runs
+        out of descriptors the least recently used half of the entries is
+        closed and the file opened once more.
+        """
+        entry = self.entries.get(url_path)
+        if entry is not None:
+            now = time.monotonic()
+            if now - entry.checked <= self.ttl or self.is_fresh(entry):
+                entry.checked = now
+                self.entries.move_to_end(url_path)
+                self.hits += 1
+                return entry.acquire()
+            self.discard(url_path)
+        self.misses += 1
+        try:
+            entry = self.open(url_path)
+        except OSError as error:
+            if error.errno not in (EMFILE, ENFILE) or not self.entries:
+                raise
+            for _ in range((len(self.entries) + 1) // 2):
+                self.discard(next(iter(self.entries)))
+            entry = self.open(url_path)
+        self.entries[url_path] = entry
+        while len(self.entries) > self.max_entries:
+            self.discard(next(iter(self.entries)))
+        return entry.acquire()
+
+    def open(self, url_path):
+        path = self.resolve(url_path)
+        file = open(path, 'rb')
+        try:
+            stat = os.fstat(file.fileno())
+            if not S_ISREG(stat.st_mode):
+                raise IsADirectoryError(path)
+        except BaseException:
+            file.close()
+            raise
+        content_type = mimetypes.guess_type(path)[0] or \
+            'application/octet-stream'
+        return CachedFile(url_path, path, file, stat, content_type)
+
+    def is_fresh(self, entry):
+        try:
+            stat = os.stat(entry.path)
+        except OSError:
+            return False
+        return entry.identity == (stat.st_dev, stat.st_ino, stat.st_size,
+                                  stat.st_mtime_ns)
+
+    def can_render(self, entry):
+        return entry.size <= self.render_limit and \
+            self.rendered_size + entry.size <= self.render_budget
+
+    def store_rendered(self, entry, key, date, response):
+        """Keep the serialized response of a cached small file."""
+        if entry.size > self.render_limit or \
+                self.entries.get(entry.url_path) is not entry:
+            return
+        previous = entry.rendered.get(key)
+        size = len(response) - (len(previous[1]) if previous else 0)
+        if self.rendered_size + size > self.render_budget:
+            return
+        entry.rendered[key] = (date, response)
+        self.rendered_size += size
+
+    def discard(self, url_path):
+        entry = self.entries.pop(url_path, None)
+        if entry is not None:
+            self.rendered_size -= sum(
+                len(response) for _, response in entry.rendered.values()
+            )
+            entry.rendered.clear()
+            entry.release()
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'rendered_bytes': self.rendered_size,
+        }
+
+    def clear(self):
+        while self.entries:
+            self.discard(next(iter(self.entries)))
+
+
+class FileBody:
+    """A region of a cached file streamed to the socket with os.sendfile()."""
+
+    __slots__ = ('file', 'offset', 'count')
+
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def close(self):
+        self.file.release()
+
+
+def parse_http_date(value):
+    """Return the timestamp of an HTTP date or None if it is malformed."""
+    try:
+        parsed = parsedate_tz(value.decode('latin-1'))
+        return mktime_tz(parsed) if parsed else None
+    except (OverflowError, ValueError):
+        return None
+
+
+def etag_matches(etag, value):
+    """Weak comparison of etag with an If-None-Match list."""
+    value = value.decode('latin-1')
+    if value.strip() == '*':
+        return True
+    for candidate in value.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def parse_range(value, size, max_ranges=16):
+    """Return the (first, last) byte positions of a Range header value.
+
+    Returns None when the header has to be ignored (another unit, a syntax
+    error or more than max_ranges ranges) and an empty list when none of
+    the ranges can be satisfied.
+    """
+    unit, _, spec = value.partition(b'=')
+    if unit.strip().lower() != b'bytes':
+        return None
+    parts = [part.strip() for part in spec.split(b',')]
+    parts = [part for part in parts if part]
+    if not parts or len(parts) > max_ranges:
+        return None
+    ranges = []
+    for part in parts:
+        first, dash, last = part.partition(b'-')
+        first, last = first.strip(), last.strip()
+        if not dash or (first and not first.isdigit()) or \
+                (last and not last.isdigit()) or not (first or last):
+            return None
+        if not first:
+            # suffix range: the last bytes of the file
+            if int(last):
+                ranges.append((max(0, size - int(last)), size - 1))
+            continue
+        first = int(first)
+        if not last:
+            last = size - 1
+        elif int(last) < first:
+            return None
+        else:
+            last = min(int(last), size - 1)
+        if first < size:
+            ranges.append((first, last))
+    return ranges
+
+
+class RequestError(Exception):
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class Request:
+    """A parsed request head.
+
+    Header names and values are kept as offsets into the parser buffer and
+    only sliced out on lookup, so the request is valid until the next
+    RequestParser.feed().
+    """
+
+    __slots__ = ('buffer', 'method', 'target', 'version', 'headers')
+
+    def __init__(self, buffer, method, target, version, headers):
+        self.buffer = buffer
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+
+    def get_header(self, name, default=b''):
+        """Return the stripped value of the first header called name.
+
+        name has to be lowercase bytes.
+        """
+        buffer = self.buffer
+        size = len(name)
+        for name_start, name_end, value_start, value_end in self.headers:
+            if name_end - name_start == size and \
+                    buffer[name_start:name_end].lower() == name:
+                return bytes(buffer[value_start:value_end]).strip()
+        return default
+
+
+class RequestParser:
+    """Incremental parser of pipelined request heads.
+
+    Data is appended to a single bytearray; the search for the end of the
+    head resumes where the previous one stopped and the request line and
+    headers are then split in one pass over the head, so the cost is
+    linear in the number of received bytes.
+    """
+
+    EOR = b'\r\n\r\n'
+
+    __slots__ = ('max_head_size', 'max_headers', 'buffer', 'start',
+                 'scanned', 'skip')
+
+    def __init__(self, max_head_size=8192, max_headers=100):
+        self.max_head_size = max_head_size
+        self.max_headers = max_headers
+        self.buffer = bytearray()
+        self.reset()
+
+    def reset(self):
+        self.buffer.clear()
+        # start of the first unparsed request
+        self.start = 0
+        # offset from which the search for EOR continues
+        self.scanned = 0
+        # bytes of the current request body still to be discarded
+        self.skip = 0
+
+    def feed(self, data):
+        if self.start:
+            # drop the parsed requests, what is left is at most one head
+            del self.buffer[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+        self.buffer += data
+
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+    def next_request(self):
+        """Return the next complete Request or None.
+
+        Raises RequestError for malformed or too large heads.
+        """
+        buffer = self.buffer
+        start = self.start
+        if self.skip:
+            skipped = min(self.skip, len(buffer) - start)
+            self.skip -= skipped
+            start += skipped
+            self.start = self.scanned = start
+            if self.skip:
+                return None
+        # tolerate empty lines between pipelined requests
+        while buffer.startswith(b'\r\n', start):
+            start += 2
+        self.start = start
+        end = buffer.find(self.EOR, max(self.scanned - 3, start))
+        if end < 0:
+            self.scanned = len(buffer)
+            if len(buffer) - start > self.max_head_size:
+                raise RequestError(431)
+            return None
+        if end - start > self.max_head_size:
+            raise RequestError(431)
+        self.start = self.scanned = end + len(self.EOR)
+
+        line_end = buffer.find(b'\r\n', start, end)
+        if line_end < 0:
+            line_end = end
+        parts = buffer[start:line_end].split(b' ')
+        if len(parts) != 3:
+            raise RequestError(400)
+        method, target, version = (bytes(part) for part in parts)
+
+        headers = []
+        pos = line_end + 2
+        while pos < end:
+            line_end = buffer.find(b'\r\n', pos, end)
+            if line_end < 0:
+                line_end = end
+            colon = buffer.find(b':', pos, line_end)
+            if colon <= pos:
+                raise RequestError(400)
+            headers.append((pos, colon, colon + 1, line_end))
+            if len(headers) > self.max_headers:
+                raise RequestError(431)
+            pos = line_end + 2
+        request = Request(buffer, method, target, version, headers)
+        if request.get_header(b'transfer-encoding'):
+            raise RequestError(501)
+        length = request.get_header(b'content-length')
+        if length:
+            if not length.isdigit():
+                raise RequestError(400)
+            # static files do not take a body, it is just skipped
+            self.skip = int(length)
+        return request
+
+
+class ParserPool:
+    """Free list of RequestParsers reused by the connections of a worker."""
+
+    def __init__(self, max_head_size=8192, size=1024):
+        self.max_head_size = max_head_size
+        self.size = size
+        self.free = []
+
+    def get(self):
+        if self.free:
+            return self.free.pop()
+        return RequestParser(self.max_head_size)
+
+    def put(self, parser):
+        if len(self.free) < self.size:
+            parser.reset()
+            self.free.append(parser)
+
+
+class Timeouts:
+    """Per-connection timeouts of one worker sharing a single reaper timer.
+
+    Every connection is subject to the timeout of exactly one phase at a
+    time.  The connections of a phase share its timeout, so keeping them
+    in an OrderedDict in the order their deadlines were set keeps them
+    sorted by deadline and expiring them only looks at the expired ones.
+    """
+
+    def __init__(self, call_later, header=10.0, body=30.0, write=30.0,
+                 keep_alive=15.0):
+        # call_later(delay, callback) returns a handle with cancel()
+        self.call_later = call_later
+        self.timeouts = {
+            'header': header,
+            'body': body,
+            'write': write,
+            'keep-alive': keep_alive,
+        }
+        self.deadlines = {phase: OrderedDict() for phase in self.timeouts}
+        # phase -> number of connections closed because of its timeout
+        self.reaped = dict.fromkeys(self.timeouts, 0)
+        self.reaper = None
+        self.reaper_deadline = None
+
+    def watch(self, channel, phase, refresh=False):
+        """Put the channel under the timeout of the phase.
+
+        The deadline is restarted on a phase change, and within the phase
+        only when refresh is true.  phase None stops watching.
+        """
+        current = channel.phase
+        if current == phase and not refresh:
+            return
+        if current is not None:
+            del self.deadlines[current][channel]
+        channel.phase = phase
+        if phase is None:
+            return
+        deadline = time.monotonic() + self.timeouts[phase]
+        self.deadlines[phase][channel] = deadline
+        if self.reaper is None or deadline < self.reaper_deadline:
+            self.schedule_reaper()
+
+    def schedule_reaper(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+        deadline = min(
+            (next(iter(channels.values()))
+             for channels in self.deadlines.values() if channels),
+            default=None
+        )
+        if deadline is not None:
+            self.reaper_deadline = deadline
+            self.reaper = self.call_later(
+                max(0.0, deadline - time.monotonic()), self.reap
+            )
+
+    def reap(self, now=None, phases=None):
+        """Close channels whose deadline has passed."""
+        if now is None:
+            now = time.monotonic()
+        for phase in phases or self.deadlines:
+            channels = self.deadlines[phase]
+            while channels:
+                channel, deadline = next(iter(channels.items()))
+                if deadline > now:
+                    break
+                self.reaped[phase] += 1
+                channel.close()
+        self.schedule_reaper()
+
+    def close_idle(self):
+        """Close every channel which is not writing a response."""
+        self.reap(float('inf'), phases=('header', 'body', 'keep-alive'))
+        logging.info('Connections closed on timeout: %s', ', '.join(
+            '{} {}'.format(phase, count)
+            for phase, count in self.reaped.items()
+        ))
+
+
+class HTTPHandler:
+    """Request processing shared by the asyncore and asyncio backends.
+
+    Parsed requests are answered by appending to self.responses either
+    bytes or a FileBody; the backend writes them out in order and calls
+    process_requests() and update_phase() once it made progress.
+    """
     
     allowed_methods = (
         b'GET', b'HEAD',
@@ -13,84 +531,1126 @@ class RequestHandler(asyncore.dispatcher):
     
     statuses = {
         200: 'OK',
-        405: 'ERROR'
+        206: 'Partial Content',
+        304: 'Not Modified',
+        400: 'Bad Request',
+        403: 'Forbidden',
+        404: 'Not Found',
+        405: 'Method Not Allowed',
+        416: 'Range Not Satisfiable',
+        431: 'Request Header Fields Too Large',
+        501: 'Not Implemented',
+        503: 'Service Unavailable',
     }
-    
-    def __init__(self, sock, static_dir):
-        asyncore.dispatcher.__init__(self, sock)
-        self.static_dir = static_dir
-        self.request = b''
-        self.EOR = b'\r\n\r\n'
-        self._readable = True
-        self.responses = deque()
-        self.body = ''
-        
-    def readable(self):
-        return self._readable
 
-    def handle_read(self):
-        self.request += self.socket.recv(1024)
-        if self.EOR in self.request:
-            self.handle_request()
-            
-    def writable(self):
-        return bool(len(self.responses))
-        
-    def handle_request(self):
-        method, path, protocol = self.request.split(b'\n')[0].split(b' ')
-        if method not in self.allowed_methods:
-            code = 405
-        elif not os.path.exists(os.path.join(self.static_dir, path)):
-            code = 404
+    # stop reading pipelined requests while this many responses are queued
+    max_pipelined = 32
+    # served when the worker runs with --stats
+    stats_path = '/__stats'
+    # more ranges in a single request are ignored and the whole file sent
+    max_ranges = 16
+
+    # The per-connection attributes are declared as __slots__ by the
+    # concrete handlers (slots of two bases can not be combined), so that
+    # an idle connection carries no instance dict.
+    __slots__ = ()
+    state_slots = ('server', 'file_cache', 'parser', 'responses', 'headers',
+                   'close_when_done', 'phase')
+
+    def __init__(self, server):
+        self.server = server
+        self.file_cache = server.file_cache
+        self.parser = server.parsers.get()
+        # a list rather than a deque: an empty deque allocates a block of
+        # 64 entries per connection while at most max_pipelined responses
+        # are ever popped from the front
+        self.responses = []
+        # only set between start_response() and end_headers()
+        self.headers = None
+        self.close_when_done = False
+        # the timeout the connection is currently subject to, see
+        # Timeouts.watch()
+        self.phase = None
+
+    def accepts_requests(self):
+        return not self.close_when_done and \
+            len(self.responses) < self.max_pipelined
+
+    def is_writing(self):
+        return bool(self.responses)
+
+    def update_phase(self, progress=False):
+        timeouts = self.server.timeouts
+        if self.is_writing():
+            # a slow reader gets write_timeout since the last progress
+            timeouts.watch(self, 'write', refresh=progress)
+        elif self.parser.skip:
+            timeouts.watch(self, 'body')
+        elif len(self.parser):
+            # a slow (or slowloris) client has header_timeout for the
+            # whole head, however it is spread over the reads
+            timeouts.watch(self, 'header')
         else:
-            code = 200
-        self.responses.append('HTTP/1.1, {code} {message}\n'.format(
-            code=code, message=self.statuses[code]
+            timeouts.watch(self, 'keep-alive')
+
+    def process_requests(self):
+        while self.accepts_requests():
+            try:
+                request = self.parser.next_request()
+            except RequestError as error:
+                return self.send_error(error.code, keep_alive=False)
+            if request is None:
+                return
+            self.handle_request(request)
+
+    def handle_request(self, request):
+        method, path, protocol = \
+            request.method, request.target, request.version
+        connection = request.get_header(b'connection').lower()
+        if protocol == b'HTTP/1.1':
+            keep_alive = connection != b'close'
+        elif protocol == b'HTTP/1.0':
+            keep_alive = connection == b'keep-alive'
+        else:
+            return self.send_error(400, keep_alive=False)
+        if self.server.stopping:
+            keep_alive = False
+        if method not in self.allowed_methods:
+            # the request may have a body we are not going to parse
+            return self.send_error(405, keep_alive=False)
+        try:
+            path = unquote(
+                path.decode('latin-1').split('?', 1)[0], errors='strict'
+            )
+        except UnicodeDecodeError:
+            return self.send_error(400, keep_alive)
+        if '\0' in path:
+            # os.path and open() raise ValueError for NUL bytes
+            return self.send_error(400, keep_alive)
+        if path == self.stats_path and self.server.collect_stats:
+            return self.send_stats(method, keep_alive)
+        try:
+            file = self.file_cache.get(path)
+        except PermissionError:
+            return self.send_error(403, keep_alive)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            return self.send_error(404, keep_alive)
+        except OSError:
+            # e.g. out of descriptors, the file may well exist
+            return self.send_error(503, keep_alive=False)
+        if not self.is_modified(file, request):
+            return self.send_not_modified(file, keep_alive)
+        if method == b'GET':
+            ranges = self.requested_ranges(file, request)
+            if ranges is not None:
+                return self.send_ranges(file, ranges, keep_alive)
+        self.send_file(file, method, keep_alive)
+
+    def is_modified(self, file, request):
+        etags = request.get_header(b'if-none-match')
+        if etags:
+            # If-Modified-Since is ignored when If-None-Match is present
+            return not etag_matches(file.etag, etags)
+        since = request.get_header(b'if-modified-since')
+        if since:
+            since = parse_http_date(since)
+            if since is not None:
+                return int(file.mtime) > since
+        return True
+
+    def requested_ranges(self, file, request):
+        """Return the satisfiable ranges or None to send the whole file."""
+        value = request.get_header(b'range')
+        if not value or not file.size:
+            return None
+        validator = request.get_header(b'if-range')
+        if validator and validator.decode('latin-1') not in \
+                (file.etag, file.last_modified):
+            # the client's copy is outdated, it gets the whole file
+            return None
+        return parse_range(value, file.size, self.max_ranges)
+
+    def send_not_modified(self, file, keep_alive):
+        self.start_response(304, keep_alive)
+        self.add_header('Last-Modified', file.last_modified)
+        self.add_header('ETag', file.etag)
+        file.release()
+        self.responses.append(self.end_headers())
+
+    def send_ranges(self, file, ranges, keep_alive):
+        """Stream the ranges of the file with sendfile() offsets."""
+        if not ranges:
+            self.start_response(416, keep_alive)
+            self.add_header('Content-Range', 'bytes */{}'.format(file.size))
+            self.add_header('Content-Length', 0)
+            file.release()
+            self.responses.append(self.end_headers())
+            return
+        self.start_response(206, keep_alive)
+        self.add_header('Last-Modified', file.last_modified)
+        self.add_header('ETag', file.etag)
+        self.add_header('Accept-Ranges', 'bytes')
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            self.add_header('Content-Type', file.content_type)
+            self.add_header('Content-Range', 'bytes {}-{}/{}'.format(
+                first, last, file.size
+            ))
+            self.add_header('Content-Length', last - first + 1)
+            self.responses.append(self.end_headers())
+            self.responses.append(FileBody(file, first, last - first + 1))
+            return
+        boundary = os.urandom(12).hex()
+        heads = [
+            ('\r\n--{}\r\nContent-Type: {}\r\n'
+             'Content-Range: bytes {}-{}/{}\r\n\r\n').format(
+                boundary, file.content_type, first, last, file.size
+            ).encode('latin-1')
+            for first, last in ranges
+        ]
+        tail = '\r\n--{}--\r\n'.format(boundary).encode('latin-1')
+        self.add_header(
+            'Content-Type', 'multipart/byteranges; boundary=' + boundary
+        )
+        self.add_header('Content-Length', len(tail) + sum(
+            len(head) + last - first + 1
+            for head, (first, last) in zip(heads, ranges)
         ))
-        #self.add_header('Date', 111)
-        self.add_header('Content-Length', self.body)
-        self.add_empty_line()
-        self.add_body()
+        self.responses.append(self.end_headers())
+        for i, (head, (first, last)) in enumerate(zip(heads, ranges)):
+            self.responses.append(head)
+            # every body holds its own reference to the file
+            self.responses.append(FileBody(
+                file if i == 0 else file.acquire(), first, last - first + 1
+            ))
+        self.responses.append(tail)
+
+    def send_file(self, file, method, keep_alive):
+        date = http_date()
+        key = method, keep_alive
+        rendered = file.rendered.get(key)
+        if rendered is not None and rendered[0] == date:
+            # pre-rendered small file: status line, headers and body
+            file.release()
+            self.close_after(keep_alive)
+            self.responses.append(rendered[1])
+            return
+        self.start_response(200, keep_alive, date)
+        self.add_header('Content-Type', file.content_type)
+        self.add_header('Content-Length', file.size)
+        self.add_header('Last-Modified', file.last_modified)
+        self.add_header('ETag', file.etag)
+        self.add_header('Accept-Ranges', 'bytes')
+        response = self.end_headers()
+        body = None
+        if method == b'GET' and file.size:
+            if self.file_cache.can_render(file):
+                body = os.pread(file.fileno(), file.size, 0)
+            if body is None or len(body) != file.size:
+                # large (or just truncated) file, stream it with sendfile
+                self.responses.append(response)
+                self.responses.append(FileBody(file, 0, file.size))
+                return
+            response += body
+        self.file_cache.store_rendered(file, key, date, response)
+        file.release()
+        self.responses.append(response)
+
+    def send_stats(self, method, keep_alive):
+        body = json.dumps(self.server.stats(), indent=2).encode('utf-8')
+        self.start_response(200, keep_alive)
+        self.add_header('Content-Type', 'application/json')
+        self.add_header('Content-Length', len(body))
+        self.add_header('Cache-Control', 'no-store')
+        response = self.end_headers()
+        if method == b'GET':
+            response += body
+        self.responses.append(response)
+
+    def send_error(self, code, keep_alive):
+        self.start_response(code, keep_alive)
+        self.add_header('Content-Length', 0)
+        self.responses.append(self.end_headers())
+
+    def close_after(self, keep_alive):
+        if not keep_alive:
+            # ignore whatever the client has pipelined after this request
+            self.close_when_done = True
+
+    def start_response(self, code, keep_alive, date=None):
+        self.close_after(keep_alive)
+        self.headers = ['HTTP/1.1 {code} {message}'.format(
+            code=code, message=self.statuses[code]
+        )]
+        self.add_header('Date', date or http_date())
+        self.add_header('Server', 'httpd.py')
+        self.add_header(
+            'Connection', 'keep-alive' if keep_alive else 'close'
+        )
             
     def add_header(self, name, value):
-        if name == 'Date':
-            self.responses.popleft(self.add_date(value))
+        self.headers.append('{}: {}'.format(name, value))
             
-    def add_empty_line(self):
-        self.responses.append('\n')
+    def end_headers(self):
+        self.headers.append('\r\n')
+        response = '\r\n'.join(self.headers).encode('latin-1')
+        self.headers = None
+        return response
+
+    def release_responses(self):
+        self.server.timeouts.watch(self, None)
+        for response in self.responses:
+            if isinstance(response, FileBody):
+                response.close()
+        self.responses.clear()
+
+    def release_parser(self):
+        # the parser is reused by another connection, only call this once
+        # nothing can feed this one any more
+        if self.parser is not None:
+            self.server.parsers.put(self.parser)
+            self.parser = None
+
+
+class RequestHandler(HTTPHandler, asyncore.dispatcher):
+
+    __slots__ = HTTPHandler.state_slots
+
+    edge_triggered = True
+
+    # buffers passed to a single sendmsg()
+    iov_max = min(os.sysconf('SC_IOV_MAX'), 1024)
+
+    def __init__(self, sock, server, map=None, addr=None):
+        asyncore.dispatcher.__init__(self, sock, map, addr)
+        HTTPHandler.__init__(self, server)
+        server.timeouts.watch(self, 'header')
         
-    def add_body(self):
-        self.responses.append('\r\n\r\n')
+    def readable(self):
+        return self.accepts_requests()
+
+    def handle_read(self):
+        # not dispatcher.recv(), which closes the channel on EOF
+        try:
+            data = self.socket.recv(4096)
+        except OSError as why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return
+            raise
+        if not data:
+            self.handle_eof()
+            return
+        self.count_received(len(data))
+        self.parser.feed(data)
+        self.process_requests()
+        self.update_phase()
+
+    def handle_eof(self):
+        # a client may half-close right after its last request, the
+        # responses queued so far are still sent; what is left in the
+        # parser is an incomplete request, as process_requests() ran dry
+        if not self.responses:
+            self.close()
+            return
+        self.close_when_done = True
+        self.update_phase()
+
+    def process_requests(self):
+        if self._fileno is None:
+            # closed by a handler, the parser is gone
+            return
+        HTTPHandler.process_requests(self)
+
+    def update_phase(self, progress=False):
+        if self._fileno is None:
+            # closed by a handler
+            return
+        HTTPHandler.update_phase(self, progress)
+            
+    def writable(self):
+        return bool(len(self.responses))
         
     def handle_write(self):
-        response = self.responses.popleft()
-        self.send(response)
+        if self._fileno is None:
+            # the read handler of the same POLLIN|POLLOUT event closed it
+            return
+        responses = self.responses
+        while responses:
+            response = responses[0]
+            if isinstance(response, FileBody):
+                if not self.sendfile(response):
+                    return self.update_phase(progress=True)
+                response.close()
+                del responses[0]
+                continue
+            # everything up to the next file body goes in one sendmsg()
+            buffers = []
+            for response in responses:
+                if isinstance(response, FileBody) or \
+                        len(buffers) == self.iov_max:
+                    break
+                buffers.append(response)
+            size = sum(len(buffer) for buffer in buffers)
+            # let the kernel coalesce the headers with the file data
+            flags = socket.MSG_MORE if len(buffers) < len(responses) else 0
+            sent = self.sendmsg(buffers, flags)
+            blocked = sent < size
+            if blocked:
+                self.would_block = True
+            while sent:
+                response = responses[0]
+                if sent < len(response):
+                    responses[0] = memoryview(response)[sent:]
+                    break
+                sent -= len(response)
+                del responses[0]
+            if blocked:
+                return self.update_phase(progress=True)
+        if self.close_when_done or self.server.stopping:
+            self.close()
+            return
+        # requests which were left unparsed while the pipeline was full
+        self.process_requests()
+        self.update_phase(progress=True)
+
+    def sendfile(self, body):
+        """Send a chunk of the body, return True once it is complete."""
+        try:
+            sent = os.sendfile(
+                self._fileno, body.file.fileno(), body.offset, body.count
+            )
+        except BlockingIOError:
+            self.would_block = True
+            return False
+        except OSError as why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return False
+            raise
+        if not sent:
+            # the file was truncated under us, the response can not be
+            # completed according to its Content-Length
+            self.handle_close()
+            return False
+        self.count_sent(sent)
+        body.offset += sent
+        body.count -= sent
+        if body.count:
+            self.would_block = True
+            return False
+        return True
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self.release_responses()
+        if self._fileno is not None:
+            self.server.connection_closed()
+            self.release_parser()
+        asyncore.dispatcher.close(self)
+
+
+class HTTPProtocol(HTTPHandler, asyncio.Protocol):
+    """The asyncio backend of a connection.
+
+    Byte responses are handed to transport.writelines() at once, file
+    bodies are streamed with loop.sendfile() by a writer task which keeps
+    the responses in order.  While the transport's buffer is above its
+    high-water mark no more pipelined requests are parsed and reading is
+    paused.
+    """
+
+    # used when the loop (e.g. uvloop) has no native sendfile
+    fallback_chunk = 64 * 1024
+    # a sendfile() call which progressed refreshes the write timeout
+    sendfile_chunk = 1024 * 1024
+
+    __slots__ = HTTPHandler.state_slots + (
+        'transport', 'writer', 'write_paused', 'write_resumed'
+    )
+
+    def __init__(self, server):
+        HTTPHandler.__init__(self, server)
+        self.transport = None
+        self.writer = None
+        self.write_paused = False
+        self.write_resumed = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+        self.server.timeouts.watch(self, 'header')
+
+    def data_received(self, data):
+        self.parser.feed(data)
+        self.process_requests()
+        if not self.accepts_requests():
+            self.transport.pause_reading()
+        self.flush()
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        # a running writer is not cancelled here: it notices the closed
+        # transport itself and releases the body it is sending
+        self.release_responses()
+        self.release_parser()
+        self.resume_writing()
+        self.server.connection_closed(self)
+
+    def pause_writing(self):
+        self.write_paused = True
+        self.server.timeouts.watch(self, 'write', refresh=True)
+
+    def resume_writing(self):
+        self.write_paused = False
+        waiter, self.write_resumed = self.write_resumed, None
+        if waiter is not None and not waiter.done():
+            # done if the writer was cancelled while waiting
+            waiter.set_result(None)
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.writer is None:
+            # parse the requests left in the buffer while writing was paused
+            self.written()
+        else:
+            self.update_phase(progress=True)
+
+    def accepts_requests(self):
+        return not self.write_paused and HTTPHandler.accepts_requests(self)
+
+    def is_writing(self):
+        return bool(self.responses) or self.write_paused or \
+            self.writer is not None
+
+    def update_phase(self, progress=False):
+        if self.transport.is_closing():
+            return
+        HTTPHandler.update_phase(self, progress)
+
+    def close(self):
+        """Drop the connection without flushing what is left to write."""
+        self.server.timeouts.watch(self, None)
+        if self.writer is not None:
+            # closing the transport under loop.sendfile() leaves it with a
+            # stale waiter, abort once the writer has been unwound
+            self.writer.add_done_callback(
+                lambda writer: self.transport.abort()
+            )
+            self.writer.cancel()
+            return
+        self.transport.abort()
+
+    def flush(self):
+        if self.writer is not None:
+            return
+        if any(isinstance(response, FileBody) for response in self.responses):
+            self.writer = self.server.loop.create_task(self.write())
+            self.update_phase()
+            return
+        self.transport.writelines(self.responses)
+        self.responses.clear()
+        self.written()
+
+    def written(self):
+        if self.close_when_done or self.server.stopping:
+            self.transport.close()
+            return
+        # requests which were left unparsed while the pipeline was full
+        self.process_requests()
+        if self.responses:
+            return self.flush()
+        if self.accepts_requests():
+            self.transport.resume_reading()
+        else:
+            self.transport.pause_reading()
+        self.update_phase()
+
+    async def write(self):
+        responses = self.responses
+        try:
+            while responses:
+                buffers = []
+                while responses and not isinstance(responses[0], FileBody):
+                    buffers.append(responses.pop(0))
+                if buffers:
+                    self.transport.writelines(buffers)
+                if not responses:
+                    break
+                # the writer owns the body from now on, connection_lost()
+                # only releases what is still queued
+                body = responses.pop(0)
+                try:
+                    await self.sendfile(body)
+                finally:
+                    body.close()
+                if self.transport.is_closing():
+                    return
+        except OSError:
+            self.transport.abort()
+            return
+        finally:
+            self.writer = None
+        self.written()
+
+    async def sendfile(self, body):
+        loop = self.server.loop
+        while body.count:
+            if self.transport.is_closing():
+                return
+            count = min(body.count, self.sendfile_chunk)
+            try:
+                await loop.sendfile(
+                    self.transport, body.file.file, body.offset, count,
+                    fallback=False
+                )
+            except (NotImplementedError, asyncio.SendfileNotAvailableError):
+                return await self.send_chunks(body)
+            body.offset += count
+            body.count -= count
+            # a slow reader gets write_timeout since the last progress
+            self.update_phase(progress=True)
+
+    async def send_chunks(self, body):
+        loop = self.server.loop
+        # pread() does not move the position of the shared descriptor
+        while body.count and not self.transport.is_closing():
+            chunk = os.pread(
+                body.file.fileno(), min(body.count, self.fallback_chunk),
+                body.offset
+            )
+            if not chunk:
+                self.transport.abort()
+                return
+            self.transport.write(chunk)
+            body.offset += len(chunk)
+            body.count -= len(chunk)
+            if self.write_paused:
+                self.write_resumed = loop.create_future()
+                await self.write_resumed
+
+
+class AsyncioServer:
+    """State shared by the HTTPProtocol connections of an asyncio worker."""
+
+    def __init__(self, loop, static_dir='.', cache_size=1024, cache_ttl=1.0,
+                 render_limit=16 * 1024, max_head_size=8192,
+                 collect_stats=False, **timeouts):
+        self.loop = loop
+        self.collect_stats = collect_stats
+        self.file_cache = FileCache(
+            static_dir, cache_size, cache_ttl, render_limit
+        )
+        self.parsers = ParserPool(max_head_size)
+        self.timeouts = Timeouts(loop.call_later, **timeouts)
+        self.connections = set()
+        self.stopping = False
+        self.server = None
+        self.stopped = loop.create_future()
+
+    async def start(self, host, port, backlog, defer_accept=0):
+        # asyncio accepts up to backlog connections per readiness event and
+        # sets TCP_NODELAY on every transport by itself
+        self.server = await self.loop.create_server(
+            lambda: HTTPProtocol(self), host or None, port,
+            backlog=backlog, reuse_address=True, reuse_port=True
+        )
+        if defer_accept:
+            for sock in self.server.sockets:
+                set_defer_accept(sock, defer_accept)
+
+    def stats(self):
+        return {
+            'backend': 'asyncio',
+            'pid': os.getpid(),
+            'connections': len(self.connections),
+            'closed_on_timeout': self.timeouts.reaped,
+            'file_cache': self.file_cache.stats(),
+        }
+
+    def connection_closed(self, protocol):
+        self.connections.discard(protocol)
+        if self.stopping and not self.connections and \
+                not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def shutdown(self):
+        """Stop accepting, close idle connections and let others finish."""
+        logging.info('Worker %s is shutting down', os.getpid())
+        self.stopping = True
+        self.server.close()
+        self.timeouts.close_idle()
+        if not self.connections and not self.stopped.done():
+            self.stopped.set_result(None)
+
         
-    
 class HTTPServer(asyncore.dispatcher):
+
+    edge_triggered = True
+    # handle_accept() drains the listen queue itself, accept_batch
+    # connections at a time
+    drain_budget = 1
+    # accept() errors which leave the connection in the listen queue: out
+    # of descriptors or memory
+    accept_errors = frozenset((EMFILE, ENFILE, ENOBUFS, ENOMEM))
+    # seconds accepting stops for after one of them
+    accept_retry_delay = 0.1
     
-    def __init__(self, address, connections_in_queue, sock=None, map=None):
+    def __init__(self, address, connections_in_queue, sock=None, map=None,
+                 static_dir='.', cache_size=1024, cache_ttl=1.0,
+                 render_limit=16 * 1024, max_head_size=8192,
+                 collect_stats=False, accept_batch=64, defer_accept=0,
+                 nodelay=False, max_connections=0, overload='pause',
+                 **timeouts):
         asyncore.dispatcher.__init__(self, sock, map)
+        self.accept_batch = accept_batch
+        self.nodelay = nodelay
+        # admission control, 0 means no limit
+        self.max_connections = max_connections
+        self.overload = overload
+        self.connections = 0
+        self.admission = {
+            'accepted': 0, 'rejected': 0, 'paused': 0, 'peak': 0,
+            'accept_errors': 0,
+        }
+        self.accept_paused = False
+        self.rejection = (None, b'')
+        self.collect_stats = collect_stats
+        if collect_stats:
+            asyncore.enable_stats()
+        self.file_cache = FileCache(
+            static_dir, cache_size, cache_ttl, render_limit
+        )
+        self.parsers = ParserPool(max_head_size)
+        self.timeouts = Timeouts(
+            lambda delay, callback: asyncore.call_later(
+                delay, callback, map=self._map
+            ),
+            **timeouts
+        )
+        self.stopping = False
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
         self.set_reuse_port()
         self.bind(address)
+        if defer_accept:
+            set_defer_accept(self.socket, defer_accept)
         self.listen(connections_in_queue)
         
     def set_reuse_port(self):
+        # lets every pre-forked worker bind its own listening socket to the
+        # same address, the kernel balances incoming connections between them
         try:
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-        except socket.error:
+        except (AttributeError, socket.error):
             pass
         
+    def readable(self):
+        # with overload='pause' new connections wait in the listen queue
+        # until a channel closes
+        if self.accept_paused:
+            return False
+        return self.overload != 'pause' or not self.overloaded()
+
+    def overloaded(self):
+        return 0 < self.max_connections <= self.connections
+
     def handle_accept(self):
-        client_info = self.accept()
-        RequestHandler(sock=client_info[0], static_dir='/')
-        
-        
+        # one readiness event can stand for many queued connections, accept
+        # them until the queue is empty rather than one per poll round
+        for _ in range(self.accept_batch):
+            if not self.accepting:
+                # closed by a signal handler
+                return
+            if self.overloaded() and self.overload == 'pause':
+                self.admission['paused'] += 1
+                return
+            try:
+                client_info = self.accept()
+            except OSError as error:
+                if error.errno not in self.accept_errors:
+                    raise
+                return self.pause_accept(error)
+            if client_info is None:
+                if self.would_block:
+                    return
+                # aborted before it was accepted
+                continue
+            sock, addr = client_info
+            if self.overloaded():
+                self.reject(sock)
+                continue
+            if self.nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            RequestHandler(sock, self, self._map, addr)
+            self.connections += 1
+            self.admission['accepted'] += 1
+            if self.connections > self.admission['peak']:
+                self.admission['peak'] = self.connections
+
+    def pause_accept(self, error):
+        # the listening socket stays ready, polling it again right away
+        # would spin; handle_error() would close it for good
+        logging.warning('Worker %s stops accepting for %ss: %s',
+                        os.getpid(), self.accept_retry_delay, error)
+        self.admission['accept_errors'] += 1
+        self.accept_paused = True
+        self.call_later(self.accept_retry_delay, self.resume_accept)
+
+    def resume_accept(self):
+        self.accept_paused = False
+        if self.accepting:
+            self.interest_changed()
+
+    def reject(self, sock):
+        """Answer 503 and close without creating a channel."""
+        self.admission['rejected'] += 1
+        date = http_date()
+        if self.rejection[0] != date:
+            self.rejection = (date, (
+                'HTTP/1.1 503 {}\r\nDate: {}\r\nServer: httpd.py\r\n'
+                'Connection: close\r\nRetry-After: 1\r\n'
+                'Content-Length: 0\r\n\r\n'
+            ).format(HTTPHandler.statuses[503], date).encode('latin-1'))
+        try:
+            # read what has arrived so that close() does not reset the
+            # connection before the client sees the response; usually
+            # nothing has arrived yet right after accept()
+            sock.recv(4096, socket.MSG_DONTWAIT)
+        except socket.error:
+            pass
+        try:
+            sock.send(self.rejection[1], socket.MSG_DONTWAIT)
+        except socket.error:
+            pass
+        sock.close()
+
+    def connection_closed(self):
+        paused = not self.readable()
+        self.connections -= 1
+        if paused and self.accepting:
+            self.interest_changed()
+
+    def shutdown(self):
+        """Stop accepting, close idle channels and let others finish."""
+        logging.info('Worker %s is shutting down', os.getpid())
+        self.stopping = True
+        self.close()
+        self.timeouts.close_idle()
+
+    def stats(self, top=10):
+        channels = [channel for channel in self._map.values()
+                    if channel is not self]
+        busiest = sorted(
+            channels, key=lambda channel: channel.bytes_out, reverse=True
+        )[:top]
+        loop_stats = asyncore.get_stats()
+        return {
+            'backend': 'asyncore',
+            'pid': os.getpid(),
+            'connections': len(channels),
+            'max_connections': self.max_connections,
+            'admission': self.admission,
+            'closed_on_timeout': self.timeouts.reaped,
+            'file_cache': self.file_cache.stats(),
+            'loop': loop_stats.as_dict() if loop_stats else None,
+            'busiest_connections': [
+                {'peer': '{}:{}'.format(*channel.addr[:2])
+                         if channel.addr else None,
+                 'bytes_in': channel.bytes_in,
+                 'bytes_out': channel.bytes_out}
+                for channel in busiest
+            ],
+        }
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.file_cache.clear()
+
+
+class SignalChannel(asyncore.dispatcher):
+    """Calls callback from the loop once one of the signals arrives.
+
+    The Python signal handlers do nothing; the interpreter writes the
+    signal number to a socket pair (signal.set_wakeup_fd()), which wakes up
+    the poller, so the callback runs as a read handler rather than at
+    whatever point of another handler the signal interrupted.
+    """
+
+    def __init__(self, signals, callback, map=None):
+        ours, self.wakeup = socket.socketpair()
+        asyncore.dispatcher.__init__(self, ours, map)
+        self.wakeup.setblocking(False)
+        self.signals = frozenset(signals)
+        self.callback = callback
+        signal.set_wakeup_fd(self.wakeup.fileno())
+        for signum in self.signals:
+            signal.signal(signum, lambda signum, frame: None)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        if self.signals.intersection(self.recv(64)):
+            self.close()
+            self.callback()
+
+    def close(self):
+        if self._fileno is not None:
+            signal.set_wakeup_fd(-1)
+            self.wakeup.close()
+        asyncore.dispatcher.close(self)
+
+
+POLLERS = {
+    'select': asyncore.select_poller,
+    'poll': asyncore.poll_poller,
+    'epoll': asyncore.epoll_poller,
+    'persistent-epoll': asyncore.persistent_epoll_poller,
+}
+
+
+def set_defer_accept(sock, seconds):
+    # Linux only: wake the worker once the first request bytes arrived
+    # instead of when the handshake completes
+    try:
+        sock.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT, int(seconds)
+        )
+    except (AttributeError, socket.error):
+        pass
+
+
+def server_options(args):
+    return dict(
+        static_dir=args.root, cache_size=args.cache_size,
+        cache_ttl=args.cache_ttl, render_limit=args.render_limit,
+        max_head_size=args.max_head_size, collect_stats=args.stats,
+        header=args.header_timeout,
+        body=args.body_timeout, write=args.write_timeout,
+        keep_alive=args.keep_alive_timeout
+    )
+
+
+def serve_asyncore(args):
+    server = HTTPServer(
+        (args.host, args.port), args.backlog,
+        accept_batch=args.accept_batch, defer_accept=args.defer_accept,
+        nodelay=args.nodelay, max_connections=args.max_connections,
+        overload=args.overload, **server_options(args)
+    )
+    # graceful shutdown: stop accepting, let open channels finish; the
+    # loop ends once they are all closed
+    SignalChannel((signal.SIGTERM, signal.SIGINT), server.shutdown)
+    asyncore.loop(timeout=1.0, poller=POLLERS[args.poller])
+
+
+def serve_asyncio(args):
+    try:
+        import uvloop
+    except ImportError:
+        loop = asyncio.new_event_loop()
+    else:
+        loop = uvloop.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = AsyncioServer(loop, **server_options(args))
+    loop.add_signal_handler(signal.SIGTERM, server.shutdown)
+    loop.add_signal_handler(signal.SIGINT, server.shutdown)
+    try:
+        loop.run_until_complete(server.start(
+            args.host, args.port, args.backlog, args.defer_accept
+        ))
+        loop.run_until_complete(server.stopped)
+    finally:
+        server.file_cache.clear()
+        loop.close()
+
+
+def serve(args):
+    if args.backend == 'asyncio':
+        serve_asyncio(args)
+    else:
+        serve_asyncore(args)
+
+
+def spawn_worker(args):
+    pid = os.fork()
+    if pid:
+        return pid
+    # the supervisor's handlers would signal the siblings until serve()
+    # installs the worker's own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    status = 0
+    try:
+        serve(args)
+    except BaseException:
+        logging.exception('Worker %s crashed', os.getpid())
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def supervise(args, restart_delay=1.0):
+    """Run args.workers forked processes and restart the ones which crash."""
+    children = {}
+    stopping = []
+
+    def stop(signum, frame):
+        if not stopping:
+            stopping.append(time.monotonic())
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(args.workers):
+        pid = spawn_worker(args)
+        children[pid] = time.monotonic()
+    logging.info('Started %d workers on %s:%d', args.workers, args.host,
+                 args.port)
+
+    while children:
+        if stopping:
+            if time.monotonic() - stopping[0] > args.shutdown_timeout:
+                for pid in children:
+                    logging.error('Killing worker %s', pid)
+                    os.kill(pid, signal.SIGKILL)
+                stopping[0] = float('inf')
+        # a blocking waitpid() would be restarted after the signal handler
+        # (PEP 475) and the shutdown timeout not checked until a worker
+        # exits by itself
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if not pid:
+            time.sleep(0.1)
+            continue
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logging.error('Worker %s exited with status %s, restarting', pid,
+                      status)
+        if time.monotonic() - started < restart_delay:
+            # do not fork-bomb when a worker dies right at start
+            time.sleep(restart_delay)
+        if not stopping:
+            pid = spawn_worker(args)
+            children[pid] = time.monotonic()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='')
+    parser.add_argument('-p', '--port', type=int, default=5672)
+    parser.add_argument(
+        '-r', '--root', default='.', help='Directory with the static files.'
+    )
+    parser.add_argument(
+        '--backend', choices=('asyncore', 'asyncio'), default='asyncore',
+        help='Event loop running the handlers; asyncio uses uvloop when it '
+             'is installed.'
+    )
+    parser.add_argument(
+        '--poller', choices=sorted(POLLERS), default='persistent-epoll',
+        help='Poller of the asyncore backend.'
+    )
+    parser.add_argument(
+        '--backlog', type=int, default=socket.SOMAXCONN,
+        help='Length of the listen queue (capped by net.core.somaxconn).'
+    )
+    parser.add_argument(
+        '--accept-batch', type=int, default=64,
+        help='Connections accepted per readiness event by the asyncore '
+             'backend; asyncio accepts up to --backlog.'
+    )
+    parser.add_argument(
+        '--defer-accept', type=int, default=0, metavar='SECONDS',
+        help='Set TCP_DEFER_ACCEPT: accept connections only once data '
+             'arrived, waiting at most this long (Linux).'
+    )
+    parser.add_argument(
+        '--nodelay', action='store_true',
+        help='Set TCP_NODELAY on accepted connections (asyncio always '
+             'does).'
+    )
+    parser.add_argument(
+        '--max-connections', type=int, default=0,
+        help='Open connections per asyncore worker, 0 for no limit.'
+    )
+    parser.add_argument(
+        '--overload', choices=('pause', 'reject'), default='pause',
+        help='At --max-connections either stop accepting until a '
+             'connection closes or answer new ones with 503.'
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='Collect event loop statistics and serve them at /__stats.'
+    )
+    parser.add_argument(
+        '-w', '--workers', type=int, default=1,
+        help='Number of worker processes sharing the port via SO_REUSEPORT.'
+    )
+    parser.add_argument(
+        '--shutdown-timeout', type=float, default=10.0,
+        help='Seconds to wait for workers to finish before killing them.'
+    )
+    parser.add_argument(
+        '--cache-size', type=int, default=1024,
+        help='Number of open static files kept in the LRU cache, at most '
+             'half of the descriptor limit (ulimit -n).'
+    )
+    parser.add_argument(
+        '--cache-ttl', type=float, default=1.0,
+        help='Seconds after which a cached file is checked for changes.'
+    )
+    parser.add_argument(
+        '--render-limit', type=int, default=16 * 1024,
+        help='Files up to this size are kept as pre-rendered responses.'
+    )
+    parser.add_argument(
+        '--keep-alive-timeout', type=float, default=15.0,
+        help='Seconds an idle persistent connection is kept open.'
+    )
+    parser.add_argument(
+        '--header-timeout', type=float, default=10.0,
+        help='Seconds a client has to send a complete request head.'
+    )
+    parser.add_argument(
+        '--body-timeout', type=float, default=30.0,
+        help='Seconds a client has to send a request body.'
+    )
+    parser.add_argument(
+        '--write-timeout', type=float, default=30.0,
+        help='Seconds a response may make no progress before closing.'
+    )
+    parser.add_argument(
+        '--max-head-size', type=int, default=8192,
+        help='Limit for the request line and headers, in bytes.'
+    )
+    return parser.parse_args()
+
+
 def main():
-    server = HTTPServer(('', 5672), 10)
-    asyncore.loop()
+    args = parse_args()
+    logging.basicConfig(
+        format='[%(asctime)s] %(levelname).1s %(message)s',
+        datefmt='%Y.%m.%d %H:%M:%S',
+        level=logging.INFO
+    )
+    if args.workers > 1:
+        supervise(args)
+    else:
+        serve(args)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
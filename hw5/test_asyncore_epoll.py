@@ -0,0 +1,255 @@
+import select
+import socket
+import time
+import unittest
+from unittest.mock import patch
+
+import asyncore_epoll as asyncore
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_call_later(self):
+        timers = asyncore.scheduler()
+        called = []
+        timers.call_later(0.02, called.append, 'b')
+        timers.call_later(0.01, called.append, 'a')
+        cancelled = timers.call_later(0.0, called.append, 'cancelled')
+        late = timers.call_later(60, called.append, 'late')
+        self.assertEqual(len(timers), 4)
+        cancelled.cancel()
+        cancelled.cancel()
+        self.assertEqual(len(timers), 3)
+        self.assertEqual(timers.run(), 0)
+        time.sleep(0.03)
+        self.assertEqual(timers.run(), 2)
+        self.assertEqual(called, ['a', 'b'])
+        self.assertEqual(len(timers), 1)
+        late.cancel()
+        self.assertEqual(len(timers), 0)
+        self.assertEqual(timers.timeout(5.0), 5.0)
+        self.assertEqual(timers.heap, [])
+
+    def test_timeout(self):
+        timers = asyncore.scheduler()
+        self.assertIsNone(timers.timeout(None))
+        self.assertEqual(timers.timeout(30.0), 30.0)
+        first = timers.call_later(10, lambda: None)
+        timers.call_later(20, lambda: None)
+        self.assertAlmostEqual(timers.timeout(30.0), 10, places=1)
+        self.assertEqual(timers.timeout(1.0), 1.0)
+        # no timeout means waiting until the first deadline
+        self.assertAlmostEqual(timers.timeout(None), 10, places=1)
+        self.assertAlmostEqual(timers.timeout(-1), 10, places=1)
+        first.cancel()
+        self.assertAlmostEqual(timers.timeout(30.0), 20, places=1)
+        timers.call_later(-1, lambda: None)
+        self.assertEqual(timers.timeout(30.0), 0.0)
+
+    def test_failing_callback(self):
+        timers = asyncore.scheduler()
+        called = []
+        timers.call_later(0, lambda: 1 / 0)
+        timers.call_later(0, called.append, 1)
+        with patch('builtins.print') as print_:
+            self.assertEqual(timers.run(), 2)
+        self.assertEqual(called, [1])
+        self.assertIn('ZeroDivisionError', print_.call_args[0][0])
+
+    def test_channel_timers(self):
+        map = {}
+        ours, theirs = socket.socketpair()
+        try:
+            channel = asyncore.dispatcher(ours, map)
+            called = []
+            channel.call_later(0, called.append, 'fired')
+            kept = channel.call_later(0.05, called.append, 'kept')
+            channel.cancel(kept)
+            asyncore.loop(0.01, map=map, count=1)
+            self.assertEqual(called, ['fired'])
+            pending = channel.call_later(0.01, called.append, 'closed')
+            channel.close()
+            self.assertTrue(pending.cancelled)
+            self.assertEqual(called, ['fired'])
+        finally:
+            theirs.close()
+            asyncore.close_all(map)
+
+
+class Channel(asyncore.dispatcher):
+
+    def __init__(self, sock, map):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.reading = True
+        self.data = b''
+        self.outgoing = b''
+
+    def readable(self):
+        return self.reading
+
+    def writable(self):
+        return bool(self.outgoing)
+
+    def handle_read(self):
+        self.data += self.recv(4096)
+
+    def handle_write(self):
+        self.outgoing = self.outgoing[self.send(self.outgoing):]
+
+
+class TestEpollPollster(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        self.peers = []
+
+    def tearDown(self):
+        asyncore.close_all(self.map)
+        asyncore.close_epoll_pollster(self.map)
+        for peer in self.peers:
+            peer.close()
+
+    def channel(self):
+        ours, theirs = socket.socketpair()
+        self.peers.append(theirs)
+        return Channel(ours, self.map), theirs
+
+    def test_register_modify_unregister(self):
+        channel, peer = self.channel()
+        pollster = asyncore.get_epoll_pollster(self.map)
+        self.assertIs(asyncore.get_epoll_pollster(self.map), pollster)
+        fd = channel._fileno
+        asyncore.persistent_epoll_poller(0, self.map)
+        self.assertEqual(pollster.registered[fd],
+                         select.EPOLLIN | select.EPOLLPRI)
+        # predicates changed outside of a handler
+        channel.reading = False
+        channel.outgoing = b'x'
+        channel.interest_changed()
+        asyncore.persistent_epoll_poller(0, self.map)
+        self.assertEqual(pollster.registered[fd], select.EPOLLOUT)
+        self.assertEqual(peer.recv(10), b'x')
+        # the handler changed them, without interest_changed(); a channel
+        # without interest stays registered with an empty mask
+        asyncore.persistent_epoll_poller(0, self.map)
+        self.assertEqual(pollster.registered[fd], 0)
+        self.assertEqual(pollster.epoll.poll(0), [])
+        channel.reading = True
+        channel.interest_changed()
+        peer.send(b'data')
+        asyncore.persistent_epoll_poller(0, self.map)
+        self.assertEqual(channel.data, b'data')
+        channel.close()
+        self.assertNotIn(fd, pollster.registered)
+        self.assertNotIn(fd, pollster.dirty)
+        self.assertEqual(self.map, {})
+
+    def test_edge_triggered(self):
+        channel, peer = self.channel()
+        channel.edge_triggered = True
+        channel.drain_budget = 2
+        pollster = asyncore.get_epoll_pollster(self.map)
+        asyncore.persistent_epoll_poller(0, self.map)
+        self.assertEqual(pollster.registered[channel._fileno],
+                         select.EPOLLIN | select.EPOLLPRI | select.EPOLLET)
+        # more than drain_budget reads: the rest is left pending
+        peer.send(b'x' * 4096 * 3)
+        asyncore.persistent_epoll_poller(0, self.map)
+        self.assertEqual(len(channel.data), 4096 * 2)
+        self.assertIn(channel._fileno, pollster.pending)
+        asyncore.persistent_epoll_poller(0, self.map)
+        self.assertEqual(len(channel.data), 4096 * 3)
+
+    def test_closed_descriptor(self):
+        channel, peer = self.channel()
+        pollster = asyncore.get_epoll_pollster(self.map)
+        asyncore.persistent_epoll_poller(0, self.map)
+        fd = channel._fileno
+        # closed behind the pollster's back, the number is then reused
+        channel.socket.close()
+        channel.del_channel()
+        reused, peer = self.channel()
+        self.assertEqual(reused._fileno, fd)
+        asyncore.persistent_epoll_poller(0, self.map)
+        self.assertEqual(pollster.registered[fd],
+                         select.EPOLLIN | select.EPOLLPRI)
+        peer.send(b'data')
+        asyncore.persistent_epoll_poller(0, self.map)
+        self.assertEqual(reused.data, b'data')
+
+
+class TestStats(unittest.TestCase):
+
+    def tearDown(self):
+        asyncore.disable_stats()
+
+    def test_pollers(self):
+        pollers = (asyncore.select_poller, asyncore.poll_poller,
+                   asyncore.epoll_poller, asyncore.persistent_epoll_poller)
+        for poller in pollers:
+            with self.subTest(poller=poller.__name__):
+                map = {}
+                ours, theirs = socket.socketpair()
+                try:
+                    channel = Channel(ours, map)
+                    channel.outgoing = b'x'
+                    theirs.send(b'data')
+                    stats = asyncore.enable_stats()
+                    asyncore.loop(0.1, poller=poller, map=map, count=1)
+                    self.assertEqual(channel.data, b'data')
+                    self.assertEqual(theirs.recv(10), b'x')
+                    self.assertEqual(stats.iterations, 1)
+                    self.assertEqual(stats.poll_time.total, 1)
+                    self.assertGreaterEqual(stats.events, 1)
+                    self.assertEqual(stats.handler_time['read'].total, 1)
+                finally:
+                    asyncore.disable_stats()
+                    theirs.close()
+                    asyncore.close_all(map)
+                    asyncore.close_epoll_pollster(map)
+
+
+class Sender(asyncore.dispatcher_with_send):
+
+    writes = 0
+
+    def handle_write(self):
+        self.writes += 1
+        asyncore.dispatcher_with_send.handle_write(self)
+
+
+class TestDispatcherWithSend(unittest.TestCase):
+
+    def test_send(self):
+        map = {}
+        ours, theirs = socket.socketpair()
+        theirs.setblocking(False)
+        try:
+            channel = Sender(ours, map)
+            # larger than the socket buffer, so that the first send is short
+            data = bytes(range(256)) * 40960
+            channel.send(data)
+            self.assertTrue(channel.paused)
+            received = bytearray()
+            while len(received) < len(data):
+                asyncore.poll_poller(0.1, map)
+                while True:
+                    try:
+                        chunk = theirs.recv(1 << 20)
+                    except BlockingIOError:
+                        break
+                    received += chunk
+            self.assertEqual(received, data)
+            self.assertEqual(channel.bytes_sent, len(data))
+            self.assertFalse(channel.paused)
+            # every write event fills the socket buffer rather than sending
+            # a single max_write_size chunk
+            chunks = len(data) // channel.max_write_size
+            self.assertLess(channel.writes, chunks // 2)
+        finally:
+            theirs.close()
+            asyncore.close_all(map)
+
+
+if __name__ == '__main__':
+    unittest.main()
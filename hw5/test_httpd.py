@@ -0,0 +1,733 @@
+import asyncio
+import errno
+import os
+import select
+import signal
+import socket
+import threading
+import time
+import unittest
+from argparse import Namespace
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import asyncore_epoll as asyncore
+import httpd
+
+
+DATE = 'Thu, 01 Jan 2026 00:00:00 GMT'
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs an HTTPServer whose connections are socket pairs."""
+
+    files = {'a.txt': b'hello\n'}
+    poller = staticmethod(asyncore.persistent_epoll_poller)
+
+    def setUp(self):
+        self.root = TemporaryDirectory()
+        for name, data in self.files.items():
+            with open(os.path.join(self.root.name, name), 'wb') as f:
+                f.write(data)
+        self.map = {}
+        self.server = httpd.HTTPServer(
+            ('127.0.0.1', 0), 16, map=self.map, static_dir=self.root.name
+        )
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        asyncore.close_all(self.map)
+        asyncore.close_epoll_pollster(self.map)
+        self.root.cleanup()
+
+    def connect(self):
+        ours, theirs = socket.socketpair()
+        httpd.RequestHandler(ours, self.server, self.map)
+        self.server.connections += 1
+        theirs.setblocking(False)
+        self.clients.append(theirs)
+        return theirs
+
+    def exchange(self, client, data, responses, seconds=1.0):
+        """Send data, return what was received and whether it was closed.
+
+        Waits until the responses have arrived and then until the server
+        closes the connection, at most seconds.
+        """
+        if data:
+            client.sendall(data)
+        received = b''
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            asyncore.loop(0.01, map=self.map, count=1, poller=self.poller)
+            try:
+                chunk = client.recv(65536)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                return received, True
+            received += chunk
+            if received.count(b'HTTP/1.1 ') > responses:
+                break
+        return received, False
+
+
+@patch('httpd.http_date', return_value=DATE)
+class TestKeepAlive(ServerTestCase):
+
+    def test_close(self, http_date):
+        requests = (
+            b'GET /a.txt HTTP/1.0\r\n\r\n',
+            b'GET /a.txt HTTP/1.1\r\nConnection: close\r\n\r\n',
+        )
+        for request in requests:
+            # the second response of every kind is the pre-rendered one
+            for _ in range(2):
+                received, closed = self.exchange(self.connect(), request, 1)
+                self.assertTrue(received.startswith(b'HTTP/1.1 200 OK\r\n'))
+                self.assertIn(b'\r\nConnection: close\r\n', received)
+                self.assertTrue(received.endswith(b'\r\n\r\nhello\n'))
+                self.assertTrue(closed)
+
+    def test_pipelining(self, http_date):
+        client = self.connect()
+        received, closed = self.exchange(
+            client, b'GET /a.txt HTTP/1.1\r\n\r\n' * 3, 3, seconds=0.2
+        )
+        self.assertEqual(received.count(b'HTTP/1.1 200 OK\r\n'), 3)
+        self.assertEqual(received.count(b'\r\nConnection: keep-alive\r\n'), 3)
+        self.assertFalse(closed)
+        # whatever follows Connection: close is ignored
+        received, closed = self.exchange(
+            client,
+            b'HEAD /a.txt HTTP/1.1\r\nConnection: close\r\n\r\n'
+            b'GET /a.txt HTTP/1.1\r\n\r\n', 2
+        )
+        self.assertEqual(received.count(b'HTTP/1.1 200 OK\r\n'), 1)
+        self.assertFalse(received.endswith(b'hello\n'))
+        self.assertTrue(closed)
+
+    def test_half_close(self, http_date):
+        pollers = (asyncore.select_poller, asyncore.poll_poller,
+                   asyncore.persistent_epoll_poller)
+        for poller in pollers:
+            with self.subTest(poller=poller.__name__):
+                self.poller = poller
+                # the requests are answered before the connection is closed
+                client = self.connect()
+                client.sendall(b'GET /a.txt HTTP/1.1\r\n\r\n' * 2 +
+                               b'GET /a.txt HTTP/1.1\r\n')
+                client.shutdown(socket.SHUT_WR)
+                received, closed = self.exchange(client, b'', 2)
+                self.assertEqual(received.count(b'HTTP/1.1 200 OK\r\n'), 2)
+                self.assertTrue(received.endswith(b'hello\n'))
+                self.assertTrue(closed)
+                client = self.connect()
+                client.shutdown(socket.SHUT_WR)
+                self.assertEqual(self.exchange(client, b'', 0), (b'', True))
+
+
+class TestRequests(ServerTestCase):
+
+    def test_bad_targets(self):
+        client = self.connect()
+        for target in (b'/%00', b'/a.txt%00.html', b'/%ff'):
+            received, closed = self.exchange(
+                client, b'GET ' + target + b' HTTP/1.1\r\n\r\n', 1,
+                seconds=0.1
+            )
+            self.assertTrue(
+                received.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+            )
+            self.assertFalse(closed)
+        received, _ = self.exchange(
+            client, b'GET /%61.txt HTTP/1.1\r\n\r\n', 1, seconds=0.1
+        )
+        self.assertTrue(received.endswith(b'\r\n\r\nhello\n'))
+
+    def test_errors(self):
+        for data, status in (
+                (b'GET / HTTP/1.1\r\n' + b'A: b\r\n' * 200 + b'\r\n',
+                 b'431'),
+                (b'GET / HTTP/2\r\n\r\n', b'400'),
+                (b'DELETE /a.txt HTTP/1.1\r\n\r\n', b'405'),
+                (b'GET /a.txt HTTP/1.1\r\nTransfer-Encoding: chunked'
+                 b'\r\n\r\n', b'501')):
+            received, closed = self.exchange(self.connect(), data, 1)
+            self.assertEqual(received[9:12], status)
+            self.assertIn(b'\r\nConnection: close\r\n', received)
+            self.assertTrue(closed)
+
+    def test_file_errors(self):
+        client = self.connect()
+        for target in (b'/missing', b'/a.txt/b', b'/'):
+            received, closed = self.exchange(
+                client, b'GET ' + target + b' HTTP/1.1\r\n\r\n', 1,
+                seconds=0.1
+            )
+            self.assertTrue(
+                received.startswith(b'HTTP/1.1 404 Not Found\r\n'), target
+            )
+            self.assertFalse(closed)
+        # the file exists, the worker is out of descriptors
+        error = OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+        with patch.object(self.server.file_cache, 'open', side_effect=error):
+            received, closed = self.exchange(
+                client, b'GET /a.txt HTTP/1.1\r\n\r\n', 1
+            )
+        self.assertTrue(
+            received.startswith(b'HTTP/1.1 503 Service Unavailable\r\n')
+        )
+        self.assertTrue(closed)
+
+    def test_closed_by_read(self):
+        client = self.connect()
+        channel, = (channel for channel in self.map.values()
+                    if channel is not self.server)
+        client.close()
+        with patch.object(channel, 'handle_error') as handle_error:
+            asyncore.readwrite(channel, select.POLLIN | select.POLLOUT)
+        self.assertIsNone(channel._fileno)
+        handle_error.assert_not_called()
+
+
+class TestAdmission(ServerTestCase):
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        self.server.max_connections = 1
+
+    def connect_tcp(self):
+        client = socket.create_connection(self.server.socket.getsockname())
+        client.setblocking(False)
+        self.clients.append(client)
+        return client
+
+    def run_loop(self, count=3):
+        asyncore.loop(0.01, map=self.map, count=count, poller=self.poller)
+
+    def test_pause(self):
+        first, second = self.connect_tcp(), self.connect_tcp()
+        self.run_loop()
+        # the second connection waits in the listen queue
+        self.assertEqual(self.server.connections, 1)
+        self.assertGreaterEqual(self.server.admission['paused'], 1)
+        self.assertFalse(self.server.readable())
+        first.close()
+        received, closed = self.exchange(
+            second, b'GET /a.txt HTTP/1.1\r\n\r\n', 1, seconds=0.2
+        )
+        self.assertTrue(received.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertEqual(self.server.admission['accepted'], 2)
+        self.assertEqual(self.server.admission['rejected'], 0)
+
+    def test_accept_batch(self):
+        self.server.max_connections = 0
+        self.server.accept_batch = 2
+        for _ in range(3):
+            self.connect_tcp()
+        self.server.handle_accept()
+        self.assertEqual(self.server.connections, 2)
+        self.server.handle_accept()
+        self.assertEqual(self.server.connections, 3)
+        self.assertTrue(self.server.would_block)
+        self.assertEqual(self.server.admission['accepted'], 3)
+
+    def test_accept_errors(self):
+        client = self.connect_tcp()
+        error = OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+        with patch.object(socket.socket, 'accept', side_effect=error), \
+                self.assertLogs(level='WARNING'):
+            self.run_loop(count=1)
+        # the listening socket is kept, accepting resumes a bit later
+        self.assertTrue(self.server.accepting)
+        self.assertFalse(self.server.readable())
+        self.assertEqual(self.server.admission['accept_errors'], 1)
+        self.assertEqual(self.server.connections, 0)
+        received, closed = self.exchange(
+            client, b'GET /a.txt HTTP/1.1\r\n\r\n', 1, seconds=0.5
+        )
+        self.assertTrue(received.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_reject(self):
+        self.server.overload = 'reject'
+        first, second = self.connect_tcp(), self.connect_tcp()
+        # the second client has not sent its request yet
+        self.run_loop()
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.admission['rejected'], 1)
+        received, closed = self.exchange(second, b'', 1)
+        self.assertTrue(
+            received.startswith(b'HTTP/1.1 503 Service Unavailable\r\n')
+        )
+        self.assertIn(b'\r\nRetry-After: 1\r\n', received)
+        self.assertTrue(closed)
+        received, closed = self.exchange(
+            first, b'GET /a.txt HTTP/1.1\r\n\r\n', 1, seconds=0.2
+        )
+        self.assertTrue(received.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertFalse(closed)
+
+
+class TestSignalChannel(unittest.TestCase):
+
+    def test_signal(self):
+        map = {}
+        called = []
+        previous = signal.getsignal(signal.SIGUSR1)
+        try:
+            channel = httpd.SignalChannel(
+                (signal.SIGUSR1, ), lambda: called.append(len(map)), map
+            )
+            os.kill(os.getpid(), signal.SIGUSR1)
+            # the callback runs from the loop, which then has nothing left
+            asyncore.loop(1.0, map=map, count=1,
+                          poller=asyncore.persistent_epoll_poller)
+            self.assertEqual(called, [0])
+            self.assertIsNone(channel._fileno)
+            self.assertEqual(signal.set_wakeup_fd(-1), -1)
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+            asyncore.close_all(map)
+            asyncore.close_epoll_pollster(map)
+
+def stubborn_worker(args):
+    # a worker which does not finish on SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(5)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.handlers = {signum: signal.getsignal(signum)
+                         for signum in (signal.SIGTERM, signal.SIGINT)}
+
+    def tearDown(self):
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+
+    @patch('httpd.serve', lambda args: os._exit(
+        signal.getsignal(signal.SIGTERM) is not signal.SIG_DFL
+    ))
+    def test_worker_signals(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: None)
+        pid = httpd.spawn_worker(None)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+    @patch('httpd.serve', stubborn_worker)
+    def test_shutdown_timeout(self):
+        args = Namespace(workers=2, host='', port=0, shutdown_timeout=0.2)
+        timer = threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM))
+        started = time.monotonic()
+        timer.start()
+        with self.assertLogs(level='ERROR') as logs:
+            httpd.supervise(args)
+        timer.join()
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn('Killing worker', logs.output[0])
+
+
+class TestRequestParser(unittest.TestCase):
+
+    def parse_error(self, data, **options):
+        parser = httpd.RequestParser(**options)
+        parser.feed(data)
+        with self.assertRaises(httpd.RequestError) as context:
+            parser.next_request()
+        return context.exception.code
+
+    def test_pipelining(self):
+        parser = httpd.RequestParser()
+        parser.feed(b'GET /a HTTP/1.1\r\nHost: x\r\n\r\n'
+                    b'HEAD /b?c=d HTTP/1.0\r\nConnection:  keep-alive \r\n'
+                    b'\r\n\r\nGET /c HT')
+        request = parser.next_request()
+        self.assertEqual((request.method, request.target, request.version),
+                         (b'GET', b'/a', b'HTTP/1.1'))
+        self.assertEqual(request.get_header(b'host'), b'x')
+        self.assertEqual(request.get_header(b'connection'), b'')
+        request = parser.next_request()
+        self.assertEqual((request.method, request.target, request.version),
+                         (b'HEAD', b'/b?c=d', b'HTTP/1.0'))
+        self.assertEqual(request.get_header(b'connection'), b'keep-alive')
+        self.assertIsNone(parser.next_request())
+        # the rest of the head arrives a byte at a time
+        for byte in b'TP/1.1\r\nX-A: 1\r\n\r\n':
+            self.assertIsNone(parser.next_request())
+            parser.feed(bytes([byte]))
+        request = parser.next_request()
+        self.assertEqual(request.target, b'/c')
+        self.assertEqual(request.get_header(b'x-a'), b'1')
+        self.assertIsNone(parser.next_request())
+        self.assertEqual(len(parser), 0)
+
+    def test_body_skipping(self):
+        parser = httpd.RequestParser()
+        parser.feed(b'GET /a HTTP/1.1\r\nContent-Length: 10\r\n\r\n0123')
+        self.assertEqual(parser.next_request().target, b'/a')
+        self.assertIsNone(parser.next_request())
+        self.assertEqual(parser.skip, 6)
+        parser.feed(b'456789GET /b HTTP/1.1\r\n\r\n')
+        self.assertEqual(parser.next_request().target, b'/b')
+        self.assertEqual(parser.skip, 0)
+
+    def test_errors(self):
+        self.assertEqual(self.parse_error(b'GET /\r\n\r\n'), 400)
+        self.assertEqual(self.parse_error(b'GET / HTTP/1.1 x\r\n\r\n'), 400)
+        self.assertEqual(
+            self.parse_error(b'GET / HTTP/1.1\r\nno colon\r\n\r\n'), 400
+        )
+        self.assertEqual(self.parse_error(
+            b'GET / HTTP/1.1\r\nContent-Length: -1\r\n\r\n'
+        ), 400)
+        self.assertEqual(self.parse_error(
+            b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+        ), 501)
+        # too large heads, complete or not
+        self.assertEqual(self.parse_error(
+            b'GET /' + b'a' * 100 + b' HTTP/1.1\r\n\r\n', max_head_size=64
+        ), 431)
+        self.assertEqual(self.parse_error(
+            b'GET /' + b'a' * 100, max_head_size=64
+        ), 431)
+        self.assertEqual(self.parse_error(
+            b'GET / HTTP/1.1\r\n' + b'A: b\r\n' * 4 + b'\r\n',
+            max_headers=3
+        ), 431)
+
+class TestConditionalRequests(ServerTestCase):
+
+    files = {'a.txt': b'0123456789'}
+
+    def request(self, headers=b''):
+        received, _ = self.exchange(
+            self.connect(), b'GET /a.txt HTTP/1.1\r\n' + headers + b'\r\n',
+            1, seconds=0.1
+        )
+        head, _, body = received.partition(b'\r\n\r\n')
+        return head, body
+
+    def test_parse_range(self):
+        parse_range = httpd.parse_range
+        self.assertEqual(parse_range(b'bytes=0-4', 10), [(0, 4)])
+        self.assertEqual(parse_range(b'bytes=5-', 10), [(5, 9)])
+        self.assertEqual(parse_range(b'bytes=-3', 10), [(7, 9)])
+        self.assertEqual(parse_range(b'bytes=-30', 10), [(0, 9)])
+        self.assertEqual(parse_range(b'bytes=8-20', 10), [(8, 9)])
+        self.assertEqual(parse_range(b'Bytes = 0-0, 2-3,', 10),
+                         [(0, 0), (2, 3)])
+        # unsatisfiable
+        self.assertEqual(parse_range(b'bytes=10-', 10), [])
+        self.assertEqual(parse_range(b'bytes=-0', 10), [])
+        # ignored
+        for value in (b'items=0-1', b'bytes=', b'bytes=a-1', b'bytes=1',
+                      b'bytes=-', b'bytes=5-4', b'bytes=0-0,' * 3):
+            self.assertIsNone(parse_range(value, 10, max_ranges=2), value)
+
+    def test_etag_matches(self):
+        etag = '"1-a"'
+        self.assertTrue(httpd.etag_matches(etag, b'"1-a"'))
+        self.assertTrue(httpd.etag_matches(etag, b'"x", W/"1-a"'))
+        self.assertTrue(httpd.etag_matches(etag, b' * '))
+        self.assertFalse(httpd.etag_matches(etag, b'"1-b", 1-a'))
+
+    def test_is_modified(self):
+        head, body = self.request()
+        headers = dict(
+            line.split(b': ', 1) for line in head.split(b'\r\n')[1:]
+        )
+        etag, last_modified = headers[b'ETag'], headers[b'Last-Modified']
+        self.assertEqual(headers[b'Accept-Ranges'], b'bytes')
+        for condition, status in (
+                (b'If-None-Match: ' + etag, b'304'),
+                (b'If-None-Match: "x"', b'200'),
+                (b'If-Modified-Since: ' + last_modified, b'304'),
+                (b'If-Modified-Since: Thu, 01 Jan 1970 00:00:00 GMT',
+                 b'200'),
+                (b'If-Modified-Since: yesterday', b'200'),
+                # If-None-Match wins over If-Modified-Since
+                (b'If-None-Match: "x"\r\nIf-Modified-Since: ' +
+                 last_modified, b'200')):
+            head, body = self.request(condition + b'\r\n')
+            self.assertEqual(head[9:12], status, condition)
+            self.assertEqual(body, b'' if status == b'304' else b'0123456789')
+
+    def test_ranges(self):
+        head, body = self.request(b'Range: bytes=2-4\r\n')
+        self.assertEqual(head[9:12], b'206')
+        self.assertIn(b'\r\nContent-Range: bytes 2-4/10', head)
+        self.assertEqual(body, b'234')
+        head, body = self.request(b'Range: bytes=0-0,-2\r\n')
+        self.assertIn(b'multipart/byteranges', head)
+        self.assertIn(b'Content-Range: bytes 0-0/10\r\n\r\n0\r\n', body)
+        self.assertIn(b'Content-Range: bytes 8-9/10\r\n\r\n89\r\n', body)
+        head, body = self.request(b'Range: bytes=20-\r\n')
+        self.assertEqual(head[9:12], b'416')
+        self.assertIn(b'\r\nContent-Range: bytes */10', head)
+        # a stale validator gets the whole file
+        head, body = self.request(b'Range: bytes=2-4\r\nIf-Range: "x"\r\n')
+        self.assertEqual(head[9:12], b'200')
+        self.assertEqual(body, b'0123456789')
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = TemporaryDirectory()
+        for name in 'abcd':
+            self.write(name, name.encode())
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def write(self, name, data):
+        with open(os.path.join(self.root.name, name), 'wb') as f:
+            f.write(data)
+
+    def read(self, entry):
+        return os.pread(entry.fileno(), 100, 0)
+
+    def test_lru(self):
+        cache = httpd.FileCache(self.root.name, max_entries=2)
+        for name in ('/a', '/b', '/a', '/c'):
+            cache.get(name).release()
+        self.assertEqual(list(cache.entries), ['/a', '/c'])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+        cache.clear()
+        self.assertEqual(cache.entries, {})
+
+    def test_release(self):
+        cache = httpd.FileCache(self.root.name, max_entries=1)
+        entry = cache.get('/a')
+        self.assertEqual(entry.refs, 2)
+        # evicted while a response still streams it
+        cache.get('/b').release()
+        self.assertNotIn('/a', cache.entries)
+        self.assertEqual(self.read(entry), b'a')
+        entry.release()
+        self.assertTrue(entry.file.closed)
+
+    def test_revalidation(self):
+        cache = httpd.FileCache(self.root.name, ttl=60)
+        entry = cache.get('/a')
+        entry.release()
+        self.write('a', b'changed')
+        # the change is only noticed once the entry is older than the ttl
+        self.assertIs(cache.get('/a'), entry)
+        entry.release()
+        entry.checked -= 61
+        changed = cache.get('/a')
+        changed.release()
+        self.assertIsNot(changed, entry)
+        self.assertEqual(changed.size, 7)
+        self.assertTrue(entry.file.closed)
+        changed.checked -= 61
+        self.assertIs(cache.get('/a'), changed)
+        changed.release()
+
+    def test_replaced(self):
+        cache = httpd.FileCache(self.root.name, ttl=0)
+        entry = cache.get('/a')
+        os.replace(os.path.join(self.root.name, 'b'),
+                   os.path.join(self.root.name, 'a'))
+        replaced = cache.get('/a')
+        self.assertIsNot(replaced, entry)
+        self.assertEqual(self.read(replaced), b'b')
+        # whoever holds the old entry still reads the old file
+        self.assertEqual(self.read(entry), b'a')
+        entry.release()
+        self.assertTrue(entry.file.closed)
+        replaced.release()
+        self.assertFalse(replaced.file.closed)
+
+    def test_descriptor_limit(self):
+        with patch('resource.getrlimit', return_value=(64, 4096)):
+            cache = httpd.FileCache(self.root.name, max_entries=1024)
+        self.assertEqual(cache.max_entries, 32)
+
+    def test_out_of_descriptors(self):
+        cache = httpd.FileCache(self.root.name)
+        for name in ('/a', '/b', '/c'):
+            cache.get(name).release()
+        opened = []
+
+        def open_(url_path):
+            opened.append(url_path)
+            if len(opened) == 1:
+                raise OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+            return httpd.FileCache.open(cache, url_path)
+
+        with patch.object(cache, 'open', open_):
+            cache.get('/d').release()
+        self.assertEqual(opened, ['/d', '/d'])
+        self.assertEqual(list(cache.entries), ['/c', '/d'])
+
+
+class Channel:
+
+    def __init__(self, timeouts):
+        self.timeouts = timeouts
+        self.phase = None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+        self.timeouts.watch(self, None)
+
+
+class Timer:
+
+    def __init__(self, delay, callback):
+        self.delay = delay
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TestTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.timers = []
+        self.timeouts = httpd.Timeouts(
+            self.call_later, header=10, body=20, write=30, keep_alive=40
+        )
+
+    def call_later(self, delay, callback):
+        timer = Timer(delay, callback)
+        self.timers.append(timer)
+        return timer
+
+    def test_watch(self):
+        timeouts = self.timeouts
+        first, second = Channel(timeouts), Channel(timeouts)
+        timeouts.watch(first, 'keep-alive')
+        timeouts.watch(second, 'keep-alive')
+        self.assertEqual(first.phase, 'keep-alive')
+        self.assertEqual(list(timeouts.deadlines['keep-alive']),
+                         [first, second])
+        self.assertAlmostEqual(self.timers[-1].delay, 40, places=1)
+        deadline = timeouts.deadlines['keep-alive'][first]
+        timeouts.watch(first, 'keep-alive')
+        self.assertEqual(timeouts.deadlines['keep-alive'][first], deadline)
+        # a refreshed deadline keeps the phase sorted
+        timeouts.watch(first, 'keep-alive', refresh=True)
+        self.assertEqual(list(timeouts.deadlines['keep-alive']),
+                         [second, first])
+        # an earlier deadline reschedules the reaper
+        reaper = self.timers[-1]
+        timeouts.watch(second, 'header')
+        self.assertTrue(reaper.cancelled)
+        self.assertAlmostEqual(self.timers[-1].delay, 10, places=1)
+        self.assertNotIn(second, timeouts.deadlines['keep-alive'])
+        self.assertIn(second, timeouts.deadlines['header'])
+        timeouts.watch(second, None)
+        self.assertIsNone(second.phase)
+        self.assertFalse(timeouts.deadlines['header'])
+
+    def test_reap(self):
+        timeouts = self.timeouts
+        channels = {phase: Channel(timeouts) for phase in
+                    ('header', 'body', 'write', 'keep-alive')}
+        for phase, channel in channels.items():
+            timeouts.watch(channel, phase)
+        timeouts.reap(time.monotonic() + 25)
+        self.assertEqual([phase for phase, channel in channels.items()
+                          if channel.closed], ['header', 'body'])
+        self.assertEqual(timeouts.reaped,
+                         {'header': 1, 'body': 1, 'write': 0,
+                          'keep-alive': 0})
+        self.assertAlmostEqual(self.timers[-1].delay, 30, places=1)
+        # shutting down closes everything but the responses being written
+        timeouts.close_idle()
+        self.assertTrue(channels['keep-alive'].closed)
+        self.assertFalse(channels['write'].closed)
+        self.assertEqual(timeouts.reaped['keep-alive'], 1)
+        timeouts.reap(time.monotonic() + 35)
+        self.assertTrue(channels['write'].closed)
+        # nothing is left to watch
+        self.assertTrue(self.timers[-1].cancelled)
+        self.assertIsNone(timeouts.reaper)
+
+class TestAsyncio(unittest.TestCase):
+
+    def setUp(self):
+        self.root = TemporaryDirectory()
+        for name, size in (('s.bin', 16000), ('big.bin', 8 << 20)):
+            with open(os.path.join(self.root.name, name), 'wb') as f:
+                f.write(os.urandom(size))
+        self.loop = asyncio.new_event_loop()
+        self.errors = []
+        self.loop.set_exception_handler(
+            lambda loop, context: self.errors.append(context)
+        )
+        self.server = httpd.AsyncioServer(
+            self.loop, static_dir=self.root.name, header=0.3, write=0.3
+        )
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.run_for(0.05)
+        self.server.file_cache.clear()
+        self.loop.close()
+        self.root.cleanup()
+
+    def connect(self):
+        ours, theirs = socket.socketpair()
+        theirs.setblocking(False)
+        self.clients.append(theirs)
+        _, protocol = self.loop.run_until_complete(
+            self.loop.connect_accepted_socket(
+                lambda: httpd.HTTPProtocol(self.server), ours
+            )
+        )
+        return theirs, protocol
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_pipelining_backpressure(self):
+        client, protocol = self.connect()
+        client.sendall(b'GET /s.bin HTTP/1.1\r\n\r\n' * 1000)
+        self.run_for(0.2)
+        # the unread responses are not all buffered by the server
+        self.assertTrue(protocol.write_paused)
+        self.assertLess(protocol.transport.get_write_buffer_size(), 1 << 20)
+        self.assertGreater(len(protocol.parser), 0)
+        self.assertFalse(protocol.transport.is_reading())
+        received = b''
+        while received.count(b'HTTP/1.1 200 OK') < 1000:
+            self.run_for(0.001)
+            try:
+                received += client.recv(1 << 20)
+            except BlockingIOError:
+                pass
+        self.assertEqual(protocol.phase, 'keep-alive')
+
+    def test_stalled_sendfile(self):
+        client, protocol = self.connect()
+        client.sendall(b'GET /big.bin HTTP/1.1\r\n\r\n')
+        self.run_for(0.1)
+        self.assertEqual(protocol.phase, 'write')
+        # the client does not read, the write timeout drops it
+        self.run_for(0.5)
+        self.assertTrue(protocol.transport is None or
+                        protocol.transport.is_closing())
+        self.assertEqual(self.server.timeouts.reaped['write'], 1)
+        self.assertFalse(self.server.connections)
+        self.assertEqual(self.errors, [])
+        entry = self.server.file_cache.entries['/big.bin']
+        self.assertEqual(entry.refs, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()